@@ -6,30 +6,289 @@ Frontend connects via WebSocket; each chat has one AgentSession.
 from __future__ import annotations
 
 import asyncio
-from collections.abc import AsyncIterator
+import os
+import time
+import weakref
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Callable
 from typing import Any
 
 from claude_agent_sdk import (
     AssistantMessage,
     ClaudeAgentOptions,
     ResultMessage,
+    SystemMessage,
     TextBlock,
     ToolUseBlock,
     query,
 )
+from claude_agent_sdk.types import StreamEvent
+
+import metrics
 
 DEFAULT_SYSTEM_PROMPT = """You are a helpful AI assistant. Be concise but thorough."""
 
+# Also forward partial text as `assistant_delta` events while a block is generated.
+# The finished block is still sent (and stored) as `assistant_message`.
+STREAM_ASSISTANT_DELTAS = os.environ.get("STREAM_ASSISTANT_DELTAS", "").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+# Partial text is forwarded at most this often; deltas in between are merged into one.
+# A block's finished assistant_message supersedes any deltas not forwarded yet.
+STREAM_DELTA_INTERVAL_MS = float(os.environ.get("STREAM_DELTA_INTERVAL_MS", "50"))
+
+# Agent events buffered per session before the agent's stream is paused
+AGENT_OUTPUT_QUEUE_SIZE = int(os.environ.get("AGENT_OUTPUT_QUEUE_SIZE", "1000"))
+# Depth from which consecutive text events are merged instead of queued
+AGENT_OUTPUT_MERGE_AT = int(
+    os.environ.get("AGENT_OUTPUT_MERGE_AT", str(AGENT_OUTPUT_QUEUE_SIZE // 2))
+)
+# Event types that can be merged into a queued event of the same type: content separator
+MERGEABLE_EVENT_TYPES = {"assistant_message": "\n\n", "assistant_delta": ""}
+
+_buffers: weakref.WeakSet[OutputBuffer] = weakref.WeakSet()
+metrics.gauge("agent_output_queued", lambda: sum(len(b) for b in _buffers))
+metrics.gauge(
+    "agent_output_high_water", lambda: max((b.high_water for b in _buffers), default=0)
+)
+
+
+class OutputBuffer:
+    """
+    Bounded queue between an agent's stream and Session._listen. When the
+    listener falls behind (slow DB writes, slow sockets), text events are merged
+    into the previous queued event of the same type. When the queue is full,
+    put() waits, which stops reading the SDK stream until the listener catches up.
+    """
+
+    def __init__(
+        self, maxsize: int = AGENT_OUTPUT_QUEUE_SIZE, merge_at: int = AGENT_OUTPUT_MERGE_AT
+    ) -> None:
+        self._items: deque[dict[str, Any] | None] = deque()
+        self._maxsize = maxsize
+        self._merge_at = merge_at
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self.high_water = 0
+        _buffers.add(self)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _merge(self, event: dict[str, Any]) -> bool:
+        sep = MERGEABLE_EVENT_TYPES.get(event.get("type", ""))
+        tail = self._items[-1] if self._items else None
+        if sep is None or tail is None or tail.get("type") != event["type"]:
+            return False
+        tail["content"] = tail.get("content", "") + sep + event.get("content", "")
+        metrics.inc("agent_output_merged")
+        return True
+
+    async def put(self, event: dict[str, Any]) -> None:
+        if len(self._items) >= self._merge_at and self._merge(event):
+            return
+        while len(self._items) >= self._maxsize:
+            metrics.inc("agent_output_full")
+            self._not_full.clear()
+            await self._not_full.wait()
+        self.put_nowait(event)
+
+    def put_nowait(self, event: dict[str, Any] | None) -> None:
+        """Queue regardless of the bound (errors and the end-of-stream marker)."""
+        self._items.append(event)
+        self.high_water = max(self.high_water, len(self._items))
+        self._not_empty.set()
+
+    async def get(self) -> dict[str, Any] | None:
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        item = self._items.popleft()
+        if len(self._items) < self._maxsize:
+            self._not_full.set()
+        return item
+
+
+# Agent processes (chat, research and warm-pool agents) running at once in this
+# process; turns beyond it wait for a slot. 0 means no limit.
+MAX_CONCURRENT_AGENTS = int(os.environ.get("MAX_CONCURRENT_AGENTS", "32"))
+
+
+class AgentSlots:
+    """
+    Caps the agent processes of this process. An AgentSession takes a slot
+    before it starts and frees it when it is closed or its stream ends. When
+    every slot is busy, acquire() asks the reclaimers (idle warm-pool agents,
+    idle chat agents) to close an agent, then waits. Waiters are served
+    round-robin by key (the chat id), so one chat's turns can't starve others.
+    """
+
+    def __init__(self, limit: int = MAX_CONCURRENT_AGENTS) -> None:
+        self._limit = limit
+        self._busy = 0
+        # key -> its waiters (oldest first); keys in round-robin order
+        self._waiting: OrderedDict[str, deque[asyncio.Future[None]]] = OrderedDict()
+        # Each closes one idle agent and returns True, or returns False
+        self._reclaimers: list[Callable[[], bool]] = []
+        metrics.gauge("agent_slots_busy", lambda: self._busy)
+        metrics.gauge("agent_slots_waiting", lambda: self.waiting)
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._waiting.values())
+
+    @property
+    def available(self) -> bool:
+        """True if acquire() would not wait."""
+        return (self._limit <= 0 or self._busy < self._limit) and not self._waiting
+
+    def add_reclaimer(self, reclaim: Callable[[], bool]) -> None:
+        self._reclaimers.append(reclaim)
+
+    def try_acquire(self) -> bool:
+        if not self.available:
+            return False
+        self._busy += 1
+        return True
+
+    async def acquire(self, key: str) -> None:
+        if self.try_acquire():
+            return
+        started = time.monotonic()
+        granted: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(key, deque()).append(granted)
+        metrics.inc("agent_slot_waits")
+        # A reclaimed agent's slot goes straight to the longest-waiting chat
+        for reclaim in self._reclaimers:
+            if granted.done() or reclaim():
+                break
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                self.release()  # granted just before the cancel landed
+            else:
+                self._discard(key, granted)
+            raise
+        metrics.observe("agent_slot_wait_ms", (time.monotonic() - started) * 1000)
+
+    def _discard(self, key: str, granted: asyncio.Future[None]) -> None:
+        queue = self._waiting.get(key)
+        if queue is not None and granted in queue:
+            queue.remove(granted)
+            if not queue:
+                del self._waiting[key]
+
+    def release(self) -> None:
+        self._busy -= 1
+        while self._waiting and (self._limit <= 0 or self._busy < self._limit):
+            key, queue = next(iter(self._waiting.items()))
+            granted = queue.popleft()
+            if queue:
+                self._waiting.move_to_end(key)  # this chat's next turn waits for its turn
+            else:
+                del self._waiting[key]
+            if not granted.done():
+                self._busy += 1
+                granted.set_result(None)
+
+
+agent_slots = AgentSlots()
+
 
 class AgentSession:
     """One long-running query() that reads user messages from a queue and streams events out."""
 
-    def __init__(self, system_prompt: str | None = None) -> None:
+    def __init__(
+        self,
+        system_prompt: str | None = None,
+        stream_deltas: bool = STREAM_ASSISTANT_DELTAS,
+        resume: str | None = None,
+    ) -> None:
         self._system_prompt = system_prompt or DEFAULT_SYSTEM_PROMPT
+        self._stream_deltas = stream_deltas
+        # SDK session to continue (a hibernated chat); its history is restored by the SDK
+        self._resume = resume
+        # SDK session id of this conversation, once the SDK has reported it
+        self.session_id: str | None = None
         self._input_queue: asyncio.Queue[str | None] = asyncio.Queue()
-        self._output_queue: asyncio.Queue[dict[str, Any] | None] = asyncio.Queue()
+        self._output = OutputBuffer()
         self._task: asyncio.Task[None] | None = None
         self._closed = False
+        # Holds one of agent_slots while the process may be running
+        self._has_slot = False
+        # Send times of turns awaiting their result, oldest first (the one being answered)
+        self._turn_started: deque[float] = deque()
+        self._ttft_ms: float | None = None
+        # Chat-specific instructions for an agent that was started before it had a chat
+        self._first_message_prefix: str | None = None
+        self._turns_sent = 0
+        self._started_before_first_turn = False
+        # Partial text not forwarded yet, and when the last delta was forwarded
+        self._pending_delta = ""
+        self._delta_sent_at = 0.0
+
+    @property
+    def used(self) -> bool:
+        """True once a message was sent; an unused agent can serve any chat."""
+        return self._turns_sent > 0
+
+    @property
+    def resumed(self) -> bool:
+        return self._resume is not None
+
+    @property
+    def has_slot(self) -> bool:
+        return self._has_slot
+
+    async def reserve(self, key: str) -> None:
+        """Take an agent slot before starting, waiting while all are busy."""
+        if not self._has_slot:
+            await agent_slots.acquire(key)
+            self._has_slot = True
+            if self._closed:
+                self._release_slot()
+
+    def reserve_nowait(self) -> bool:
+        if not self._has_slot:
+            self._has_slot = agent_slots.try_acquire()
+        return self._has_slot
+
+    def _release_slot(self) -> None:
+        if self._has_slot:
+            self._has_slot = False
+            agent_slots.release()
+
+    @property
+    def alive(self) -> bool:
+        return not self._closed and not (self._task is not None and self._task.done())
+
+    def bind(self, chat_prompt: str | None) -> None:
+        """
+        Give the agent chat-specific instructions before its first message.
+        Not started yet: they are appended to the system prompt. Already started
+        (a warm agent from AgentPool): they are prefixed to the first message.
+        """
+        if not chat_prompt or self.used:
+            return
+        if self._task is None:
+            self._system_prompt = f"{self._system_prompt}\n\n{chat_prompt}"
+        else:
+            self._first_message_prefix = chat_prompt
+
+    def _first_token(self) -> None:
+        """Record time-to-first-token for the current turn (once per turn)."""
+        if self._ttft_ms is not None or not self._turn_started:
+            return
+        self._ttft_ms = (time.monotonic() - self._turn_started[0]) * 1000
+        mode = "stream" if self._stream_deltas else "block"
+        metrics.observe(f"agent_ttft_ms_{mode}", self._ttft_ms)
+        if len(self._turn_started) == self._turns_sent:  # still the first turn
+            start = "warm" if self._started_before_first_turn else "cold"
+            metrics.observe(f"agent_first_ttft_ms_{start}", self._ttft_ms)
 
     def _prompt_stream(self) -> AsyncIterator[dict[str, Any]]:
         async def _stream() -> AsyncIterator[dict[str, Any]]:
@@ -41,7 +300,7 @@ class AgentSession:
                     "type": "user",
                     "message": {"role": "user", "content": content},
                     "parent_tool_use_id": None,
-                    "session_id": "",
+                    "session_id": self.session_id or self._resume or "",
                 }
 
         return _stream()
@@ -51,6 +310,8 @@ class AgentSession:
             model="claude-opus-4-6",
             system_prompt=self._system_prompt,
             max_turns=100,
+            include_partial_messages=self._stream_deltas,
+            resume=self._resume,
             allowed_tools=[
                 "Bash",
                 "Read",
@@ -67,14 +328,36 @@ class AgentSession:
             async for msg in query(prompt=self._prompt_stream(), options=options):
                 if self._closed:
                     break
-                if isinstance(msg, AssistantMessage):
+                if isinstance(msg, SystemMessage):
+                    if msg.subtype == "init" and msg.data.get("session_id"):
+                        self.session_id = msg.data["session_id"]
+                elif isinstance(msg, StreamEvent):
+                    event = msg.event
+                    delta = event.get("delta") or {}
+                    if (
+                        msg.parent_tool_use_id is None
+                        and event.get("type") == "content_block_delta"
+                        and delta.get("type") == "text_delta"
+                    ):
+                        self._first_token()
+                        self._pending_delta += delta.get("text", "")
+                        now = time.monotonic()
+                        if (now - self._delta_sent_at) * 1000 >= STREAM_DELTA_INTERVAL_MS:
+                            self._delta_sent_at = now
+                            content, self._pending_delta = self._pending_delta, ""
+                            await self._output.put({"type": "assistant_delta", "content": content})
+                elif isinstance(msg, AssistantMessage):
+                    # The blocks below carry the full text; the next block's first delta goes out at once
+                    self._pending_delta = ""
+                    self._delta_sent_at = 0.0
                     for block in msg.content:
                         if isinstance(block, TextBlock):
-                            self._output_queue.put_nowait(
+                            self._first_token()
+                            await self._output.put(
                                 {"type": "assistant_message", "content": block.text}
                             )
                         elif isinstance(block, ToolUseBlock):
-                            self._output_queue.put_nowait(
+                            await self._output.put(
                                 {
                                     "type": "tool_use",
                                     "toolName": block.name,
@@ -83,34 +366,48 @@ class AgentSession:
                                 }
                             )
                 elif isinstance(msg, ResultMessage):
-                    self._output_queue.put_nowait(
+                    self.session_id = msg.session_id or self.session_id
+                    if self._turn_started:
+                        self._turn_started.popleft()
+                    ttft_ms, self._ttft_ms = self._ttft_ms, None
+                    await self._output.put(
                         {
                             "type": "result",
                             "success": not getattr(msg, "is_error", True),
                             "cost": getattr(msg, "total_cost_usd", None),
                             "duration_ms": getattr(msg, "duration_ms", 0),
+                            # None when the turn produced no text
+                            "ttft_ms": round(ttft_ms) if ttft_ms is not None else None,
                         }
                     )
         except asyncio.CancelledError:
             pass
         except Exception as e:
             if not self._closed:
-                self._output_queue.put_nowait({"type": "error", "error": str(e)})
+                self._output.put_nowait({"type": "error", "error": str(e)})
         finally:
-            self._output_queue.put_nowait(None)
+            self._release_slot()  # the agent process has exited
+            self._output.put_nowait(None)
 
     def start(self) -> None:
         if self._task is None:
             self._task = asyncio.create_task(self._run_query())
 
     def send_message(self, content: str) -> None:
+        if not self.used:
+            self._started_before_first_turn = self._task is not None
+            if self._first_message_prefix:
+                content = f"{self._first_message_prefix}\n\n{content}"
+                self._first_message_prefix = None
         self.start()
+        self._turns_sent += 1
+        self._turn_started.append(time.monotonic())
         self._input_queue.put_nowait(content)
 
     async def get_output_stream(self) -> AsyncIterator[dict[str, Any]]:
         self.start()
         while True:
-            msg = await self._output_queue.get()
+            msg = await self._output.get()
             if msg is None:
                 break
             yield msg
@@ -120,3 +417,76 @@ class AgentSession:
         self._input_queue.put_nowait(None)
         if self._task and not self._task.done():
             self._task.cancel()
+        self._release_slot()
+
+
+# Pre-started agents kept ready for new chats (0 disables the pool)
+AGENT_POOL_SIZE = int(os.environ.get("AGENT_POOL_SIZE", "0"))
+
+
+class AgentPool:
+    """
+    Idle, already started AgentSessions that are not bound to a chat yet, so a
+    chat's first message skips spawning the agent process. checkout() never
+    waits: it hands out a warm agent if one is ready and a cold one otherwise,
+    and the pool refills in the background. Idle pool agents hold agent slots;
+    the pool only refills from free slots and is the first to give one up.
+    """
+
+    def __init__(self, size: int = AGENT_POOL_SIZE) -> None:
+        self._size = size
+        self._idle: deque[AgentSession] = deque()
+        self._running = False
+        metrics.gauge("agent_pool_idle", lambda: len(self._idle))
+        agent_slots.add_reclaimer(self._reclaim)
+
+    def start(self) -> None:
+        self._running = True
+        self._refill()
+
+    def _refill(self) -> None:
+        while self._running and len(self._idle) < self._size:
+            agent = AgentSession()
+            if not agent.reserve_nowait():
+                return  # every slot is taken; warm agents must not make turns wait
+            agent.start()
+            self._idle.append(agent)
+
+    def _reclaim(self) -> bool:
+        if not self._idle:
+            return False
+        self._idle.pop().close()
+        metrics.inc("agent_pool_reclaimed")
+        return True
+
+    def checkout(self) -> AgentSession:
+        while self._idle:
+            agent = self._idle.popleft()
+            if agent.alive:
+                metrics.inc("agent_pool_hits")
+                asyncio.get_running_loop().call_soon(self._refill)
+                return agent
+            agent.close()
+        if self._running:
+            metrics.inc("agent_pool_misses")
+            self._refill()
+        return AgentSession()
+
+    def checkin(self, agent: AgentSession) -> None:
+        """Take back an agent whose chat never used it; anything else is closed."""
+        if (
+            self._running
+            and not agent.used
+            and agent.alive
+            and agent.has_slot
+            and not agent_slots.waiting  # a turn needs the slot more
+            and len(self._idle) < self._size
+        ):
+            self._idle.append(agent)
+        else:
+            agent.close()
+
+    def close(self) -> None:
+        self._running = False
+        while self._idle:
+            self._idle.popleft().close()
@@ -0,0 +1,237 @@
+"""
+Micro-benchmarks for the chat hot paths.
+
+Run: uv run python bench.py add_message [--messages 500]
+     uv run python bench.py fanout [--events 200]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _report(name: str, samples_ms: list[float], extra: str = "") -> None:
+    samples = sorted(samples_ms)
+    p95 = samples[int(len(samples) * 0.95) - 1] if len(samples) > 1 else samples[0]
+    print(
+        f"{name:<28} mean {statistics.mean(samples):8.3f} ms"
+        f"  p50 {statistics.median(samples):8.3f} ms  p95 {p95:8.3f} ms  {extra}"
+    )
+
+
+# --- add_message: round trips and latency per persisted message ---
+
+
+class _CountingConnection:
+    """Proxies an asyncpg connection and counts statements sent to the server."""
+
+    _STATEMENTS = {"execute", "executemany", "fetch", "fetchrow", "fetchval"}
+
+    def __init__(self, conn: Any, counter: list[int]) -> None:
+        self._conn = conn
+        self._counter = counter
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._conn, name)
+        if name not in self._STATEMENTS:
+            return attr
+
+        async def counted(*args: Any, **kwargs: Any) -> Any:
+            self._counter[0] += 1
+            return await attr(*args, **kwargs)
+
+        return counted
+
+
+class _CountingPool:
+    def __init__(self, pool: Any) -> None:
+        self._pool = pool
+        self.round_trips = [0]
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[_CountingConnection]:
+        async with self._pool.acquire() as conn:
+            yield _CountingConnection(conn, self.round_trips)
+
+
+async def _legacy_add_message(pool: Any, chat_id: str, role: str, content: str) -> None:
+    """
+    The pre-CTE implementation: up to four statements, no transaction. Its
+    updated_at bump also allocates seq, which chat_messages now requires.
+    """
+    now = datetime.now(timezone.utc)
+    async with pool.acquire() as conn:
+        seq = await conn.fetchval(
+            "UPDATE chats SET last_seq = last_seq + 1, updated_at = $1 WHERE id = $2"
+            " RETURNING last_seq",
+            now,
+            chat_id,
+        )
+        await conn.execute(
+            "INSERT INTO chat_messages (id, chat_id, role, content, timestamp, seq)"
+            " VALUES ($1, $2, $3, $4, $5, $6)",
+            uuid.uuid4().hex,
+            chat_id,
+            role,
+            content,
+            now,
+            seq,
+        )
+        if role == "user":
+            row = await conn.fetchrow("SELECT title FROM chats WHERE id = $1", chat_id)
+            if row and row["title"] == "New Chat":
+                await conn.execute(
+                    "UPDATE chats SET title = $1 WHERE id = $2", content[:50], chat_id
+                )
+
+
+async def _time_messages(
+    add: Callable[[str, str, str], Awaitable[Any]],
+    chat_id: str,
+    role: str,
+    n: int,
+) -> list[float]:
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        await add(chat_id, role, f"benchmark message {i}")
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+async def bench_add_message(n: int) -> None:
+    from db import PostgresChatStore, close_pool, get_pool, init_db
+
+    pool = await get_pool()
+    await init_db(pool)
+    counting = _CountingPool(pool)
+    store = PostgresChatStore(counting)  # type: ignore[arg-type]
+    chat = await store.create_chat("add_message benchmark")
+    variants: list[tuple[str, Callable[[str, str, str], Awaitable[Any]]]] = [
+        ("legacy", lambda c, r, t: _legacy_add_message(counting, c, r, t)),
+        ("single statement", store.add_message),
+    ]
+    try:
+        for role in ("user", "assistant"):
+            for name, add in variants:
+                await _time_messages(add, chat.id, role, min(n, 20))  # warm up
+                counting.round_trips[0] = 0
+                samples = await _time_messages(add, chat.id, role, n)
+                _report(
+                    f"{name} ({role})",
+                    samples,
+                    f"round trips/msg {counting.round_trips[0] / n:.1f}",
+                )
+    finally:
+        await store.delete_chat(chat.id)
+        await close_pool()
+
+
+# --- fanout: broadcasting one event to N subscribers ---
+
+
+class _NullWebSocket:
+    """Accepts frames like a Starlette WebSocket without doing any I/O."""
+
+    def __init__(self) -> None:
+        self.frames = 0
+
+    async def send_text(self, data: str) -> None:
+        self.frames += 1
+
+    async def send_json(self, data: Any) -> None:
+        # What Starlette's send_json does before sending the text frame.
+        json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+async def _legacy_broadcast(subscribers: list[_NullWebSocket], payload: dict[str, Any]) -> None:
+    """The pre-encoding implementation: send_json (and so json.dumps) per subscriber."""
+    for ws in subscribers:
+        await ws.send_json(payload)
+
+
+def _write_tool_use_event(size: int) -> dict[str, Any]:
+    line = "    df = df.with_columns(pl.col('return').rolling_sum(21).over('ticker'))\n"
+    return {
+        "type": "tool_use",
+        "toolName": "Write",
+        "toolId": "toolu_bench",
+        "toolInput": {
+            "file_path": "research.py",
+            "content": (line * (size // len(line) + 1))[:size],
+        },
+        "chatId": uuid.uuid4().hex,
+    }
+
+
+async def _broadcast_and_drain(session: Any, conns: list[Any], payload: dict[str, Any]) -> None:
+    await session.broadcast(payload)
+    for conn in conns:
+        await conn.drain()
+
+
+async def bench_fanout(n_events: int, payload_bytes: int) -> None:
+    import connection
+    import main
+
+    payload = _write_tool_use_event(payload_bytes)
+    encoder = "orjson" if connection.orjson is not None else "json"
+    for n_subscribers in (1, 10, 100):
+        subscribers = [_NullWebSocket() for _ in range(n_subscribers)]
+        conns = [connection.Connection(ws) for ws in subscribers]
+        # Registered like a real chat: broadcasts reach subscribers through the pub/sub
+        session = main.get_session("bench")
+        for conn in conns:
+            conn.start()
+            session.subscribe(conn)
+        variants: list[tuple[str, Callable[[], Awaitable[None]]]] = [
+            ("legacy", lambda: _legacy_broadcast(subscribers, payload)),
+            (
+                f"encode once ({encoder})",
+                lambda: _broadcast_and_drain(session, conns, payload),
+            ),
+        ]
+        for name, send in variants:
+            samples = []
+            for _ in range(n_events):
+                start = time.perf_counter()
+                await send()
+                samples.append((time.perf_counter() - start) * 1000)
+            _report(f"{name} x{n_subscribers}", samples, "per event")
+        assert all(ws.frames == n_events for ws in subscribers), "broadcasts were not delivered"
+        main.sessions.pop("bench").close()
+        for conn in conns:
+            conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+    add = sub.add_parser("add_message", help="Postgres add_message (needs DATABASE_URL)")
+    add.add_argument("--messages", type=int, default=500)
+    fanout = sub.add_parser("fanout", help="Session broadcast to 1/10/100 subscribers")
+    fanout.add_argument("--events", type=int, default=200)
+    fanout.add_argument("--payload-bytes", type=int, default=50_000)
+    args = parser.parse_args()
+
+    if args.bench == "add_message":
+        asyncio.run(bench_add_message(args.messages))
+    elif args.bench == "fanout":
+        asyncio.run(bench_fanout(args.events, args.payload_bytes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Multi-process mode for one host: `python main.py --workers N`.
+
+Every worker binds the public port with SO_REUSEPORT (the kernel spreads new
+connections across them) plus its own direct port. Chat ids are mapped to
+workers with a consistent-hash ring, so each chat's session, history cache and
+agent process live in exactly one worker. A worker asked about a chat it
+doesn't own replies with a `redirect` event naming the owner's direct port.
+"""
+
+from __future__ import annotations
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+# Virtual nodes per worker; more gives a more even split of chats
+RING_VNODES = 64
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing: adding or removing a worker moves ~1/N of the chats."""
+
+    def __init__(self, nodes: list[int], vnodes: int = RING_VNODES) -> None:
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._keys = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> int:
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+# Set by the launcher in each worker process; one process owns every chat by default
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+# Direct port of worker i is WORKER_BASE_PORT + i
+WORKER_BASE_PORT = int(os.environ.get("WORKER_BASE_PORT", "8001"))
+
+_ring = HashRing(list(range(WORKER_COUNT))) if WORKER_COUNT > 1 else None
+
+
+def _configure(index: int, count: int, base_port: int) -> None:
+    global WORKER_INDEX, WORKER_COUNT, WORKER_BASE_PORT, _ring
+    WORKER_INDEX, WORKER_COUNT, WORKER_BASE_PORT = index, count, base_port
+    _ring = HashRing(list(range(count))) if count > 1 else None
+
+
+def redirect_port(chat_id: str) -> int | None:
+    """Direct port of the worker owning chat_id, or None if this process owns it."""
+    if _ring is None or not chat_id:
+        return None
+    owner = _ring.owner(chat_id)
+    if owner == WORKER_INDEX:
+        return None
+    return WORKER_BASE_PORT + owner
+
+
+def _bind(host: str, port: int, reuse_port: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app: str, host: str, port: int, index: int, count: int, base_port: int) -> None:
+    import uvicorn
+
+    _configure(index, count, base_port)
+
+    sockets = [_bind(host, port, reuse_port=True), _bind(host, base_port + index, reuse_port=False)]
+    uvicorn.Server(uvicorn.Config(app)).run(sockets=sockets)
+
+
+def serve(app: str, host: str, port: int, workers: int, base_port: int | None = None) -> None:
+    """Run `workers` processes of app; restart any that exit until SIGINT/SIGTERM."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("--workers needs SO_REUSEPORT (Linux, macOS or BSD)")
+    if not os.environ.get("DATABASE_URL"):
+        # Each worker would get its own in-memory store: chats created on one are unknown to the rest
+        raise SystemExit("--workers needs DATABASE_URL so the workers share chats and messages")
+    base_port = base_port or port + 1
+    ctx = multiprocessing.get_context("spawn")
+
+    def spawn(index: int) -> multiprocessing.process.BaseProcess:
+        proc = ctx.Process(
+            target=_run_worker,
+            args=(app, host, port, index, workers, base_port),
+            name=f"worker-{index}",
+        )
+        proc.start()
+        return proc
+
+    procs = [spawn(i) for i in range(workers)]
+    stopping = False
+
+    def stop(*_: object) -> None:
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    logger.info(
+        "Started %d workers on port %d (direct ports %d-%d)",
+        workers,
+        port,
+        base_port,
+        base_port + workers - 1,
+    )
+    while not stopping:
+        time.sleep(0.5)
+        for i, proc in enumerate(procs):
+            if not proc.is_alive() and not stopping:
+                # Its hash range is unserved until it is back
+                logger.warning("Worker %d exited with %s; restarting", i, proc.exitcode)
+                procs[i] = spawn(i)
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.join()
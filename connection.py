@@ -0,0 +1,131 @@
+"""
+One WebSocket connection with a bounded outbound queue and its own writer task.
+Broadcasts enqueue pre-encoded frames without blocking, so a slow or stalled
+browser only ever delays itself.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is used when it isn't installed
+    orjson = None
+
+# Frames buffered per connection before the overflow policy applies
+SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "1000"))
+# "drop": drop droppable events when full, disconnect for anything else.
+# "disconnect": disconnect on any overflow.
+SEND_OVERFLOW = os.environ.get("WS_SEND_OVERFLOW", "drop").strip().lower()
+# Transient events a client can miss without losing content
+# (assistant_delta text is repeated in full by the block's assistant_message)
+DROPPABLE_EVENT_TYPES = {"agent_status", "assistant_delta"}
+
+# Close code 1013 is "try again later"
+_SLOW_CONSUMER_CLOSE_CODE = 1013
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def encode_event(payload: dict[str, Any]) -> str:
+    """Encode a WebSocket payload to text (same output shape as send_json)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload).decode()
+        except TypeError:
+            pass  # e.g. integers wider than 64 bits; let json handle it
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+class Connection:
+    """Wraps a WebSocket; all outbound frames go through send()/send_json()."""
+
+    def __init__(
+        self,
+        websocket: Any,
+        max_queue: int = SEND_QUEUE_SIZE,
+        overflow: str = SEND_OVERFLOW,
+    ) -> None:
+        self.websocket = websocket
+        self._overflow = overflow
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_queue)
+        self._writer: asyncio.Task[None] | None = None
+        self.closed = False
+        self.dropped = 0
+        # Sessions this connection is subscribed to (maintained by Session.subscribe/unsubscribe)
+        self.sessions: set[Any] = set()
+
+    def start(self) -> None:
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write())
+
+    def send(self, text: str, droppable: bool = False) -> bool:
+        """Queue a pre-encoded frame. Returns False once the connection is closed."""
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(text)
+        except asyncio.QueueFull:
+            if droppable and self._overflow == "drop":
+                self.dropped += 1
+                return True
+            logger.warning(
+                "Disconnecting slow WebSocket client (%d frames queued)",
+                self._queue.qsize(),
+            )
+            self.close(code=_SLOW_CONSUMER_CLOSE_CODE)
+            return False
+        return True
+
+    def send_json(self, payload: dict[str, Any]) -> bool:
+        return self.send(
+            encode_event(payload), payload.get("type") in DROPPABLE_EVENT_TYPES
+        )
+
+    async def drain(self) -> None:
+        """Wait until every queued frame has been written (or the connection closed)."""
+        await self._queue.join()
+
+    async def _write(self) -> None:
+        try:
+            while True:
+                text = await self._queue.get()
+                try:
+                    await self.websocket.send_text(text)
+                finally:
+                    self._queue.task_done()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self._writer = None
+            self.close()
+
+    def detach(self) -> None:
+        """Unsubscribe from every session this connection joined."""
+        for session in list(self.sessions):
+            session.unsubscribe(self)
+
+    def close(self, code: int | None = None) -> None:
+        """Stop the writer; with a code, also close the socket (used to evict slow clients)."""
+        if self.closed:
+            return
+        self.closed = True
+        if self._writer is not None and not self._writer.done():
+            self._writer.cancel()
+        self._writer = None
+        while not self._queue.empty():  # release drain() waiters
+            self._queue.get_nowait()
+            self._queue.task_done()
+        if code is not None:
+            asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int) -> None:
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
@@ -5,13 +5,17 @@ Set DATABASE_URL to enable; otherwise the app uses in-memory store.
 
 from __future__ import annotations
 
+import asyncio
 import os
+from collections.abc import Callable
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 
 import asyncpg
 
+from research_jobs import ResearchJob, UPDATABLE_JOB_FIELDS
+
 DATABASE_URL = os.environ.get("DATABASE_URL")
 print(DATABASE_URL, "DATABASE_URL")
 
@@ -31,6 +35,7 @@ class ChatMessage:
     role: str
     content: str
     timestamp: str
+    seq: int = 0  # per-chat order, assigned by the store
 
 
 _pool: asyncpg.Pool | None = None
@@ -63,7 +68,27 @@ async def init_db(pool: asyncpg.Pool | None = None) -> None:
     schema_path = Path(__file__).parent / "schema.sql"
     sql = schema_path.read_text()
     async with pool.acquire() as conn:
-        await conn.execute(sql)
+        async with conn.transaction():
+            # Processes starting together (--workers, worker.py) would race on the DDL
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('at-backend init_db'))")
+            await conn.execute(sql)
+
+
+# Bumping chats.last_seq row-locks the chat, so concurrent writers get gap-free,
+# monotonically increasing seq values; the INSERT only runs if the chat exists.
+ADD_MESSAGE_SQL = """
+WITH chat AS (
+    UPDATE chats
+    SET last_seq = last_seq + 1,
+        updated_at = $5,
+        title = CASE WHEN $3 = 'user' AND title = 'New Chat' THEN $6 ELSE title END
+    WHERE id = $2
+    RETURNING last_seq
+)
+INSERT INTO chat_messages (id, chat_id, role, content, timestamp, seq)
+SELECT $1::text, $2::text, $3::text, $4::text, $5::timestamptz, last_seq FROM chat
+RETURNING seq
+"""
 
 
 class PostgresChatStore:
@@ -128,51 +153,122 @@ class PostgresChatStore:
             result = await conn.execute("DELETE FROM chats WHERE id = $1", chat_id)
         return result == "DELETE 1"
 
+    async def get_agent_session_id(self, chat_id: str) -> str | None:
+        async with self._pool.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT agent_session_id FROM chats WHERE id = $1", chat_id
+            )
+
+    async def set_agent_session_id(self, chat_id: str, session_id: str | None) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE chats SET agent_session_id = $2 WHERE id = $1", chat_id, session_id
+            )
+
     async def add_message(self, chat_id: str, role: str, content: str) -> ChatMessage:
         import uuid
         from datetime import datetime, timezone
 
         msg_id = uuid.uuid4().hex
         now = datetime.now(timezone.utc)
+        title = content[:50] + ("..." if len(content) > 50 else "")
+        # One round trip: allocate seq, bump updated_at, auto-title and insert.
         async with self._pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO chat_messages (id, chat_id, role, content, timestamp) VALUES ($1, $2, $3, $4, $5)",
-                msg_id,
-                chat_id,
-                role,
-                content,
-                now,
-            )
-            await conn.execute(
-                "UPDATE chats SET updated_at = $1 WHERE id = $2",
-                now,
-                chat_id,
+            seq = await conn.fetchval(
+                ADD_MESSAGE_SQL, msg_id, chat_id, role, content, now, title
             )
-            if role == "user":
-                row = await conn.fetchrow(
-                    "SELECT title FROM chats WHERE id = $1", chat_id
-                )
-                if row and row["title"] == "New Chat":
-                    new_title = content[:50] + ("..." if len(content) > 50 else "")
-                    await conn.execute(
-                        "UPDATE chats SET title = $1 WHERE id = $2",
-                        new_title,
-                        chat_id,
-                    )
+        if seq is None:
+            raise ValueError(f"Chat {chat_id} not found")
         return ChatMessage(
             id=msg_id,
             chat_id=chat_id,
             role=role,
             content=content,
             timestamp=now.isoformat(),
+            seq=seq,
         )
 
-    async def get_messages(self, chat_id: str) -> list[ChatMessage]:
+    async def add_messages(self, messages: list[Any]) -> None:
+        """
+        Batch-insert messages that already carry id and timestamp (write-behind
+        flushes), allocating a block of seq values per chat. Sets each message's
+        seq. Bumps updated_at only; user messages go through add_message.
+        """
+        from datetime import datetime
+
+        by_chat: dict[str, list[Any]] = {}
+        for m in messages:
+            by_chat.setdefault(m.chat_id, []).append(m)
         async with self._pool.acquire() as conn:
-            rows = await conn.fetch(
-                "SELECT id, chat_id, role, content, timestamp FROM chat_messages WHERE chat_id = $1 ORDER BY timestamp",
-                chat_id,
+            async with conn.transaction():
+                for chat_id, batch in by_chat.items():
+                    stamps = [datetime.fromisoformat(m.timestamp) for m in batch]
+                    last_seq = await conn.fetchval(
+                        "UPDATE chats SET last_seq = last_seq + $1, updated_at = GREATEST(updated_at, $2)"
+                        " WHERE id = $3 RETURNING last_seq",
+                        len(batch),
+                        max(stamps),
+                        chat_id,
+                    )
+                    if last_seq is None:
+                        raise ValueError(f"Chat {chat_id} not found")
+                    first_seq = last_seq - len(batch) + 1
+                    await conn.executemany(
+                        "INSERT INTO chat_messages (id, chat_id, role, content, timestamp, seq)"
+                        " VALUES ($1, $2, $3, $4, $5, $6)",
+                        [
+                            (m.id, chat_id, m.role, m.content, ts, first_seq + i)
+                            for i, (m, ts) in enumerate(zip(batch, stamps))
+                        ],
+                    )
+                    for i, m in enumerate(batch):
+                        m.seq = first_seq + i
+
+    async def get_messages(
+        self,
+        chat_id: str,
+        *,
+        before: str | None = None,
+        after: str | None = None,
+        after_seq: int | None = None,
+        limit: int | None = None,
+    ) -> list[ChatMessage]:
+        """
+        Messages in seq order. `before`/`after` are message ids (keyset cursors on
+        seq) and `after_seq` is a known seq, which skips the cursor lookup; with
+        `limit`, pages forward from `after`/`after_seq`, otherwise returns the
+        newest `limit` messages before `before`.
+        """
+        conditions = ["chat_id = $1"]
+        args: list[Any] = [chat_id]
+        if after is None and after_seq is not None:
+            args.append(after_seq)
+            conditions.append(f"seq > ${len(args)}")
+        async with self._pool.acquire() as conn:
+            for op, cursor in (("<", before), (">", after)):
+                if cursor is None:
+                    continue
+                seq = await conn.fetchval(
+                    "SELECT seq FROM chat_messages WHERE id = $1 AND chat_id = $2",
+                    cursor,
+                    chat_id,
+                )
+                if seq is None:
+                    raise ValueError(f"Message {cursor} not found in chat {chat_id}")
+                args.append(seq)
+                conditions.append(f"seq {op} ${len(args)}")
+            newest_first = limit is not None and after is None and after_seq is None
+            sql = (
+                "SELECT id, chat_id, role, content, timestamp, seq FROM chat_messages"
+                f" WHERE {' AND '.join(conditions)}"
+                f" ORDER BY seq {'DESC' if newest_first else 'ASC'}"
             )
+            if limit is not None:
+                args.append(limit)
+                sql += f" LIMIT ${len(args)}"
+            rows = await conn.fetch(sql, *args)
+        if newest_first:
+            rows = list(reversed(rows))
         return [
             ChatMessage(
                 id=r["id"],
@@ -180,6 +276,441 @@ class PostgresChatStore:
                 role=r["role"],
                 content=r["content"],
                 timestamp=r["timestamp"].isoformat(),
+                seq=r["seq"],
             )
             for r in rows
         ]
+
+
+_JOB_COLUMNS = (
+    "id, chat_id, topic, repo_name, status, phase, created_at, repo_url, cost, error,"
+    " worker_id, attempts, started_at, heartbeat_at, finished_at"
+)
+
+
+def _job_from_row(row: asyncpg.Record) -> ResearchJob:
+    def ts(value: Any) -> str | None:
+        return value.isoformat() if value is not None else None
+
+    return ResearchJob(
+        id=row["id"],
+        chat_id=row["chat_id"],
+        topic=row["topic"],
+        repo_name=row["repo_name"],
+        status=row["status"],
+        phase=row["phase"],
+        created_at=row["created_at"].isoformat(),
+        repo_url=row["repo_url"],
+        cost=row["cost"],
+        error=row["error"],
+        worker_id=row["worker_id"],
+        attempts=row["attempts"],
+        started_at=ts(row["started_at"]),
+        heartbeat_at=ts(row["heartbeat_at"]),
+        finished_at=ts(row["finished_at"]),
+    )
+
+
+class PostgresResearchJobStore:
+    """research_jobs table; see research_jobs.ResearchJobs for the lifecycle."""
+
+    def __init__(self, pool: asyncpg.Pool) -> None:
+        self._pool = pool
+
+    async def create_job(
+        self, chat_id: str, topic: str, repo_name: str | None, worker_id: str
+    ) -> ResearchJob | None:
+        """New queued job, or None if the chat already has an active one."""
+        import uuid
+
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "INSERT INTO research_jobs (id, chat_id, topic, repo_name, worker_id, heartbeat_at)"
+                " VALUES ($1, $2, $3, $4, $5, NOW())"
+                " ON CONFLICT (chat_id) WHERE status IN ('queued', 'running') DO NOTHING"
+                f" RETURNING {_JOB_COLUMNS}",
+                uuid.uuid4().hex,
+                chat_id,
+                topic,
+                repo_name,
+                worker_id,
+            )
+        return _job_from_row(row) if row is not None else None
+
+    async def update_job(self, job_id: str, **fields: Any) -> None:
+        fields = {k: v for k, v in fields.items() if k in UPDATABLE_JOB_FIELDS}
+        if not fields:
+            return
+        assignments = [f"{k} = ${i}" for i, k in enumerate(fields, start=2)]
+        status = fields.get("status")
+        if status == "running":
+            assignments.append("started_at = COALESCE(started_at, NOW())")
+        elif status is not None and status not in ("queued", "running"):
+            assignments.append("finished_at = NOW()")
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                f"UPDATE research_jobs SET {', '.join(assignments)} WHERE id = $1",
+                job_id,
+                *fields.values(),
+            )
+
+    async def heartbeat(self, worker_id: str) -> None:
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE research_jobs SET heartbeat_at = NOW()"
+                " WHERE worker_id = $1 AND status IN ('queued', 'running')",
+                worker_id,
+            )
+
+    async def claim_orphans(
+        self, worker_id: str, stale_after: float
+    ) -> list[ResearchJob]:
+        """Atomically take over active jobs whose heartbeat is older than stale_after seconds."""
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                "UPDATE research_jobs"
+                " SET worker_id = $1, heartbeat_at = NOW(), attempts = attempts + 1"
+                " WHERE id IN ("
+                "   SELECT id FROM research_jobs"
+                "   WHERE status IN ('queued', 'running')"
+                "     AND NOT (status = 'queued' AND worker_id IS NULL)"  # unclaimed queue entries
+                "     AND (heartbeat_at IS NULL OR heartbeat_at < NOW() - make_interval(secs => $2))"
+                "   ORDER BY created_at"
+                "   FOR UPDATE SKIP LOCKED"
+                " )"
+                f" RETURNING {_JOB_COLUMNS}",
+                worker_id,
+                stale_after,
+            )
+        return [_job_from_row(r) for r in rows]
+
+    async def release(self, worker_id: str) -> None:
+        """Mark this process's active jobs stale so the next process resumes them at once."""
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE research_jobs SET heartbeat_at = NULL"
+                " WHERE worker_id = $1 AND status IN ('queued', 'running')",
+                worker_id,
+            )
+
+
+class PostgresResearchQueue:
+    """
+    research_jobs as a work queue for RESEARCH_EXECUTOR=queue. API processes
+    enqueue jobs and notify channel research_jobs; worker.py processes claim
+    them with FOR UPDATE SKIP LOCKED. Events flow back through PostgresPubSub.
+    """
+
+    def __init__(self, pool: asyncpg.Pool) -> None:
+        self._pool = pool
+        self._listener: asyncpg.Connection | None = None
+        self._jobs_available = asyncio.Event()
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+
+    async def enqueue_job(
+        self, chat_id: str, topic: str, repo_name: str | None
+    ) -> ResearchJob | None:
+        """Queue a job for any worker, or None if the chat already has an active one."""
+        import uuid
+
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    "INSERT INTO research_jobs (id, chat_id, topic, repo_name)"
+                    " VALUES ($1, $2, $3, $4)"
+                    " ON CONFLICT (chat_id) WHERE status IN ('queued', 'running') DO NOTHING"
+                    f" RETURNING {_JOB_COLUMNS}",
+                    uuid.uuid4().hex,
+                    chat_id,
+                    topic,
+                    repo_name,
+                )
+                if row is not None:
+                    await conn.execute("SELECT pg_notify('research_jobs', $1)", row["id"])
+        return _job_from_row(row) if row is not None else None
+
+    async def claim_next(self, worker_id: str) -> ResearchJob | None:
+        """Take the oldest unclaimed queued job; concurrent workers skip each other's rows."""
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "UPDATE research_jobs"
+                " SET worker_id = $1, heartbeat_at = NOW()"
+                " WHERE id = ("
+                "   SELECT id FROM research_jobs"
+                "   WHERE status = 'queued' AND worker_id IS NULL"
+                "   ORDER BY created_at"
+                "   FOR UPDATE SKIP LOCKED"
+                "   LIMIT 1"
+                " )"
+                f" RETURNING {_JOB_COLUMNS}",
+                worker_id,
+            )
+        return _job_from_row(row) if row is not None else None
+
+    async def cancel_unclaimed(self, chat_id: str) -> bool:
+        """Cancel the chat's job if it is still waiting for a worker."""
+        async with self._pool.acquire() as conn:
+            job_id = await conn.fetchval(
+                "UPDATE research_jobs SET status = 'cancelled', finished_at = NOW()"
+                " WHERE chat_id = $1 AND status = 'queued' AND worker_id IS NULL"
+                " RETURNING id",
+                chat_id,
+            )
+        return job_id is not None
+
+    async def wait_for_jobs(self, timeout: float) -> None:
+        """Sleep until a job is enqueued (NOTIFY research_jobs) or timeout seconds pass."""
+        if self._listener is None:
+            self._listener = await asyncpg.connect(DATABASE_URL)
+            await self._listener.add_listener(
+                "research_jobs", lambda *_: self._jobs_available.set()
+            )
+        try:
+            await asyncio.wait_for(self._jobs_available.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._jobs_available.clear()
+
+
+# NOTIFY payloads must stay under 8000 bytes; larger events go through chat_event_spill
+NOTIFY_MAX_BYTES = 7900
+PUBSUB_CHANNEL = "chat_events"
+# Messages for whichever process holds a chat's lease (see PostgresChatLeases)
+COMMAND_CHANNEL = "chat_commands"
+# Spilled payloads are only read right after the NOTIFY; older rows are pruned
+SPILL_RETENTION_SECONDS = 300
+
+
+class PostgresPubSub:
+    """
+    Fan-out through LISTEN/NOTIFY on channel chat_events. Events are delivered
+    locally right away and sent to other processes by one sender task, in
+    publish order. A notification carries origin, droppable (0/1), chat_id and the
+    event on separate lines; the event is the encoded frame or "@<chat_event_spill id>".
+    send_command() uses the same format on channel chat_commands, with a JSON body.
+    Pass deliver=None to publish only (worker.py).
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        deliver: Callable[[str, str, bool], None] | None,
+        on_command: Callable[[str, dict[str, Any]], None] | None = None,
+    ) -> None:
+        import uuid
+
+        self._pool = pool
+        self._deliver = deliver
+        self._on_command = on_command
+        self._origin = uuid.uuid4().hex[:12]
+        self._outbox: asyncio.Queue[tuple[str, str, str]] = asyncio.Queue()
+        self._inbox: asyncio.Queue[tuple[str, str]] = asyncio.Queue()
+        self._listener: asyncpg.Connection | None = None
+        self._tasks: list[asyncio.Task[None]] = []
+
+    async def start(self) -> None:
+        self._tasks.append(asyncio.create_task(self._send_loop()))
+        if self._deliver is not None or self._on_command is not None:
+            await self._listen()
+            self._tasks.append(asyncio.create_task(self._receive_loop()))
+
+    async def publish(self, chat_id: str, text: str, droppable: bool = False) -> None:
+        if self._deliver is not None:
+            self._deliver(chat_id, text, droppable)
+        self._outbox.put_nowait(
+            (PUBSUB_CHANNEL, f"{self._origin}\n{int(droppable)}\n{chat_id}\n", text)
+        )
+
+    async def send_command(self, chat_id: str, command: dict[str, Any]) -> None:
+        """Send a command to the other processes; the one that owns chat_id acts on it."""
+        import json
+
+        self._outbox.put_nowait(
+            (COMMAND_CHANNEL, f"{self._origin}\n0\n{chat_id}\n", json.dumps(command))
+        )
+
+    async def close(self) -> None:
+        # Let queued events reach other processes before stopping
+        try:
+            await asyncio.wait_for(self._outbox.join(), 5)
+        except asyncio.TimeoutError:
+            pass
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            await listener.close()
+
+    async def _send_loop(self) -> None:
+        import logging
+
+        logger = logging.getLogger("uvicorn.error")
+        loop = asyncio.get_running_loop()
+        last_prune = 0.0
+        while True:
+            channel, header, text = await self._outbox.get()
+            try:
+                async with self._pool.acquire() as conn:
+                    if len((header + text).encode()) <= NOTIFY_MAX_BYTES:
+                        await conn.execute("SELECT pg_notify($1, $2)", channel, header + text)
+                    else:
+                        await conn.execute(
+                            "WITH s AS ("
+                            "   INSERT INTO chat_event_spill (payload) VALUES ($3) RETURNING id"
+                            " )"
+                            " SELECT pg_notify($1, $2 || '@' || id) FROM s",
+                            channel,
+                            header,
+                            text,
+                        )
+                    if loop.time() - last_prune > SPILL_RETENTION_SECONDS:
+                        last_prune = loop.time()
+                        await conn.execute(
+                            "DELETE FROM chat_event_spill"
+                            " WHERE created_at < NOW() - make_interval(secs => $1)",
+                            SPILL_RETENTION_SECONDS,
+                        )
+            except Exception as e:
+                logger.warning("Could not publish on %s: %s", channel, e)
+            finally:
+                self._outbox.task_done()
+
+    async def _listen(self) -> None:
+        self._listener = await asyncpg.connect(DATABASE_URL)
+        self._listener.add_termination_listener(self._on_listener_lost)
+
+        def on_notify(_conn: Any, _pid: int, channel: str, payload: str) -> None:
+            self._inbox.put_nowait((channel, payload))
+
+        if self._deliver is not None:
+            await self._listener.add_listener(PUBSUB_CHANNEL, on_notify)
+        if self._on_command is not None:
+            await self._listener.add_listener(COMMAND_CHANNEL, on_notify)
+
+    def _on_listener_lost(self, _conn: asyncpg.Connection) -> None:
+        if self._listener is not None:  # not closed by us
+            self._tasks.append(asyncio.create_task(self._reconnect()))
+
+    async def _reconnect(self) -> None:
+        import logging
+
+        logger = logging.getLogger("uvicorn.error")
+        delay = 1.0
+        while True:
+            logger.warning("Pub/sub LISTEN connection lost; reconnecting in %.0fs", delay)
+            await asyncio.sleep(delay)
+            try:
+                await self._listen()
+                return
+            except Exception:
+                delay = min(delay * 2, 30.0)
+
+    async def _receive_loop(self) -> None:
+        import json
+        import logging
+
+        logger = logging.getLogger("uvicorn.error")
+        # One consumer keeps delivery in NOTIFY order, even while fetching spilled events
+        while True:
+            channel, payload = await self._inbox.get()
+            try:
+                origin, droppable, chat_id, text = payload.split("\n", 3)
+                if origin == self._origin:
+                    continue
+                if text.startswith("@"):
+                    async with self._pool.acquire() as conn:
+                        text = await conn.fetchval(
+                            "SELECT payload FROM chat_event_spill WHERE id = $1", int(text[1:])
+                        )
+                    if text is None:
+                        continue  # pruned before we got to it
+                if channel == COMMAND_CHANNEL and self._on_command is not None:
+                    self._on_command(chat_id, json.loads(text))
+                elif self._deliver is not None:
+                    self._deliver(chat_id, text, droppable == "1")
+            except Exception as e:
+                # One bad notification must not stop delivery for the whole process
+                logger.warning("Dropped a %s notification: %s", channel, e)
+
+
+# Seed for hashing chat ids into advisory lock keys, so they don't collide with other users of advisory locks
+_LEASE_KEY_SEED = 0x61745F6C65617365  # "at_lease"
+
+
+class PostgresChatLeases:
+    """
+    Chat ownership with session-level advisory locks, all held on one dedicated
+    connection. The process holding a chat's lock is the only one running its
+    agent. If the process dies, its connection closes and Postgres releases its
+    locks, so another process can take over. If the connection drops while the
+    process is alive, on_lost(chat_ids) is called so it can stop those agents.
+    """
+
+    def __init__(self, on_lost: Callable[[list[str]], None] | None = None) -> None:
+        self._on_lost = on_lost
+        self._conn: asyncpg.Connection | None = None
+        self._lock = asyncio.Lock()  # one statement at a time on the lease connection
+        self._held: set[str] = set()
+
+    def holds(self, chat_id: str) -> bool:
+        return chat_id in self._held
+
+    @property
+    def held_count(self) -> int:
+        return len(self._held)
+
+    async def acquire(self, chat_id: str) -> bool:
+        """Take the lease for chat_id if no other process holds it. Idempotent."""
+        if chat_id in self._held:
+            return True
+        async with self._lock:
+            if chat_id in self._held:
+                return True
+            if self._conn is None or self._conn.is_closed():
+                self._conn = await asyncpg.connect(DATABASE_URL)
+                self._conn.add_termination_listener(self._on_connection_lost)
+            got = await self._conn.fetchval(
+                "SELECT pg_try_advisory_lock(hashtextextended($1, $2))",
+                chat_id,
+                _LEASE_KEY_SEED,
+            )
+            if got:
+                self._held.add(chat_id)
+            return got
+
+    def release(self, chat_id: str) -> None:
+        """Give up the lease (non-blocking; the unlock runs in the background)."""
+        if chat_id in self._held:
+            self._held.discard(chat_id)
+            asyncio.create_task(self._unlock(chat_id))
+
+    async def _unlock(self, chat_id: str) -> None:
+        async with self._lock:
+            if self._conn is None or self._conn.is_closed():
+                return  # the lock went with the connection
+            # Advisory locks stack: a re-acquire before this ran took a second hold
+            await self._conn.fetchval(
+                "SELECT pg_advisory_unlock(hashtextextended($1, $2))",
+                chat_id,
+                _LEASE_KEY_SEED,
+            )
+
+    def _on_connection_lost(self, conn: asyncpg.Connection) -> None:
+        if conn is not self._conn:
+            return
+        lost, self._held = list(self._held), set()
+        self._conn = None
+        if lost and self._on_lost is not None:
+            self._on_lost(lost)
+
+    async def close(self) -> None:
+        async with self._lock:
+            self._held = set()
+            if self._conn is not None:
+                conn, self._conn = self._conn, None
+                await conn.close()  # releases every lock
@@ -0,0 +1,46 @@
+"""
+Chat ownership: the process holding a chat's lease is the only one that runs
+its agent. Others forward `chat` messages to it (see pubsub send_command).
+The Postgres implementation is db.PostgresChatLeases.
+"""
+
+from __future__ import annotations
+
+from typing import Protocol
+
+
+class ChatLeasesProtocol(Protocol):
+    def holds(self, chat_id: str) -> bool: ...
+
+    @property
+    def held_count(self) -> int: ...
+
+    async def acquire(self, chat_id: str) -> bool: ...
+
+    def release(self, chat_id: str) -> None: ...
+
+    async def close(self) -> None: ...
+
+
+class LocalChatLeases:
+    """Single process: every chat is owned here (sessions already dedupe per chat)."""
+
+    def __init__(self) -> None:
+        self._held: set[str] = set()
+
+    def holds(self, chat_id: str) -> bool:
+        return chat_id in self._held
+
+    @property
+    def held_count(self) -> int:
+        return len(self._held)
+
+    async def acquire(self, chat_id: str) -> bool:
+        self._held.add(chat_id)
+        return True
+
+    def release(self, chat_id: str) -> None:
+        self._held.discard(chat_id)
+
+    async def close(self) -> None:
+        self._held.clear()
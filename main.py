@@ -9,39 +9,68 @@ from __future__ import annotations
 
 import asyncio
 import os
+import time
 
 from dotenv import load_dotenv
 
 load_dotenv()  # load .env before reading os.environ
 import uuid
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from datetime import datetime, timezone
 from typing import Any, Protocol
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import RedirectResponse
 from pydantic import BaseModel
 
-from agent import AgentSession
+import metrics
+from agent import AgentPool, AgentSession, agent_slots
+from cluster import redirect_port
+from connection import Connection, DROPPABLE_EVENT_TYPES, encode_event
+from leases import ChatLeasesProtocol, LocalChatLeases
+from pubsub import LocalPubSub, PubSubProtocol
+from research_jobs import QueuedResearchJobs, ResearchJobs
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     import logging
 
-    global chat_store
+    global chat_store, leases, persister, pubsub, research_jobs
     logger = logging.getLogger("uvicorn.error")
     using_postgres = False
     if os.environ.get("DATABASE_URL"):
         try:
-            from db import close_pool, get_pool, init_db, PostgresChatStore
+            from db import (
+                close_pool,
+                get_pool,
+                init_db,
+                PostgresChatLeases,
+                PostgresChatStore,
+                PostgresPubSub,
+                PostgresResearchJobStore,
+                PostgresResearchQueue,
+            )
 
             pool = await get_pool()
             await init_db(pool)
             chat_store = PostgresChatStore(pool)
+            research_jobs.store = PostgresResearchJobStore(pool)
             using_postgres = True
             logger.info("Using PostgreSQL for chat persistence")
+            if PUBSUB == "postgres" or RESEARCH_EXECUTOR == "queue":
+                # Workers publish research events through Postgres, so queue mode needs it too
+                pubsub = PostgresPubSub(pool, _deliver, _handle_command)
+                leases = PostgresChatLeases(on_lost=_on_leases_lost)
+                logger.info("Fanning out chat events with Postgres LISTEN/NOTIFY")
+            if RESEARCH_EXECUTOR == "queue":
+                research_jobs = QueuedResearchJobs(
+                    PostgresResearchQueue(pool), _publish_research_event
+                )
+                logger.info("Research jobs run on worker.py processes")
         except Exception as e:
             logger.warning(
                 "Could not connect to PostgreSQL (%s). Using in-memory store. "
@@ -49,9 +78,31 @@ async def lifespan(app: FastAPI):
                 e,
             )
             chat_store = InMemoryChatStore()
+    if os.environ.get("WRITE_BEHIND", "").lower() in ("1", "true", "yes"):
+        persister = WriteBehindPersister(
+            chat_store,
+            batch_size=int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "50")),
+            flush_interval=int(os.environ.get("WRITE_BEHIND_FLUSH_MS", "200")) / 1000,
+        )
+        persister.start()
+        logger.info("Write-behind persistence enabled for assistant messages")
+    await pubsub.start()
+    agent_pool.start()
+    reaper = asyncio.create_task(_reap_idle_sessions())
+    await research_jobs.startup()
     try:
         yield
     finally:
+        reaper.cancel()
+        agent_pool.close()
+        await research_jobs.shutdown()
+        if persister is not None:
+            try:
+                await persister.close()
+            except Exception as e:
+                logger.warning("Could not flush buffered messages on shutdown: %s", e)
+        await pubsub.close()
+        await leases.close()
         if using_postgres:
             try:
                 from db import close_pool
@@ -86,6 +137,7 @@ class ChatMessage:
     role: str
     content: str
     timestamp: str
+    seq: int = 0  # per-chat order, assigned by the store
 
 
 class ChatStoreProtocol(Protocol):
@@ -96,7 +148,18 @@ class ChatStoreProtocol(Protocol):
     async def add_message(
         self, chat_id: str, role: str, content: str
     ) -> ChatMessage: ...
-    async def get_messages(self, chat_id: str) -> list[ChatMessage]: ...
+    async def add_messages(self, messages: list[ChatMessage]) -> None: ...
+    async def get_messages(
+        self,
+        chat_id: str,
+        *,
+        before: str | None = None,
+        after: str | None = None,
+        after_seq: int | None = None,
+        limit: int | None = None,
+    ) -> list[ChatMessage]: ...
+    async def get_agent_session_id(self, chat_id: str) -> str | None: ...
+    async def set_agent_session_id(self, chat_id: str, session_id: str | None) -> None: ...
 
 
 class InMemoryChatStore:
@@ -105,6 +168,9 @@ class InMemoryChatStore:
     def __init__(self) -> None:
         self._chats: dict[str, Chat] = {}
         self._messages: dict[str, list[ChatMessage]] = {}
+        # message id -> index in its chat's list (append-only, so index == seq - 1)
+        self._positions: dict[str, int] = {}
+        self._agent_session_ids: dict[str, str] = {}
 
     async def create_chat(self, title: str | None = None) -> Chat:
         chat_id = uuid.uuid4().hex
@@ -123,9 +189,20 @@ class InMemoryChatStore:
         return sorted(self._chats.values(), key=lambda c: c.updated_at, reverse=True)
 
     async def delete_chat(self, chat_id: str) -> bool:
-        self._messages.pop(chat_id, None)
+        for msg in self._messages.pop(chat_id, []):
+            self._positions.pop(msg.id, None)
+        self._agent_session_ids.pop(chat_id, None)
         return self._chats.pop(chat_id, None) is not None
 
+    async def get_agent_session_id(self, chat_id: str) -> str | None:
+        return self._agent_session_ids.get(chat_id)
+
+    async def set_agent_session_id(self, chat_id: str, session_id: str | None) -> None:
+        if session_id is None:
+            self._agent_session_ids.pop(chat_id, None)
+        elif chat_id in self._chats:
+            self._agent_session_ids[chat_id] = session_id
+
     async def add_message(self, chat_id: str, role: str, content: str) -> ChatMessage:
         if chat_id not in self._messages:
             raise ValueError(f"Chat {chat_id} not found")
@@ -136,7 +213,9 @@ class InMemoryChatStore:
             role=role,
             content=content,
             timestamp=now,
+            seq=len(self._messages[chat_id]) + 1,
         )
+        self._positions[msg.id] = len(self._messages[chat_id])
         self._messages[chat_id].append(msg)
         chat = self._chats.get(chat_id)
         if chat:
@@ -145,12 +224,234 @@ class InMemoryChatStore:
                 chat.title = content[:50] + ("..." if len(content) > 50 else "")
         return msg
 
-    async def get_messages(self, chat_id: str) -> list[ChatMessage]:
-        return self._messages.get(chat_id, [])
+    async def add_messages(self, messages: list[ChatMessage]) -> None:
+        for msg in messages:
+            if msg.chat_id not in self._messages:
+                raise ValueError(f"Chat {msg.chat_id} not found")
+            msg.seq = len(self._messages[msg.chat_id]) + 1
+            self._positions[msg.id] = len(self._messages[msg.chat_id])
+            self._messages[msg.chat_id].append(msg)
+            chat = self._chats.get(msg.chat_id)
+            if chat:
+                chat.updated_at = msg.timestamp
+
+    def _position(self, chat_id: str, message_id: str) -> int:
+        messages = self._messages.get(chat_id, [])
+        index = self._positions.get(message_id)
+        if index is None or index >= len(messages) or messages[index].id != message_id:
+            raise ValueError(f"Message {message_id} not found in chat {chat_id}")
+        return index
+
+    async def get_messages(
+        self,
+        chat_id: str,
+        *,
+        before: str | None = None,
+        after: str | None = None,
+        after_seq: int | None = None,
+        limit: int | None = None,
+    ) -> list[ChatMessage]:
+        messages = self._messages.get(chat_id, [])
+        start, end = 0, len(messages)
+        if after is not None:
+            start = self._position(chat_id, after) + 1
+        elif after_seq is not None:
+            start = min(max(after_seq, 0), end)
+        if before is not None:
+            end = self._position(chat_id, before)
+        if limit is not None:
+            # Page forward from `after`, otherwise take the newest page before `before`.
+            if after is not None or after_seq is not None:
+                end = min(end, start + limit)
+            else:
+                start = max(start, end - limit)
+        return messages[start:end]
+
+
+class WriteBehindPersister:
+    """
+    Buffers assistant messages per chat and writes them with store.add_messages in
+    batches (on batch_size or every flush_interval seconds), so broadcasting never
+    waits on the database. Ids and timestamps are assigned at enqueue time.
+    """
+
+    def __init__(
+        self,
+        store: ChatStoreProtocol,
+        batch_size: int = 50,
+        flush_interval: float = 0.2,
+    ) -> None:
+        self._store = store
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffers: dict[str, list[ChatMessage]] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._task: asyncio.Task[None] | None = None
+
+    def enqueue(self, chat_id: str, role: str, content: str) -> ChatMessage:
+        msg = ChatMessage(
+            id=uuid.uuid4().hex,
+            chat_id=chat_id,
+            role=role,
+            content=content,
+            timestamp=datetime.now(timezone.utc).isoformat(),
+        )
+        buffer = self._buffers.setdefault(chat_id, [])
+        buffer.append(msg)
+        if len(buffer) >= self._batch_size:
+            asyncio.create_task(self._flush_logged(chat_id))
+        return msg
+
+    async def flush(self, chat_id: str | None = None) -> None:
+        """Barrier: returns once everything enqueued before the call (for one chat or all) is stored."""
+        for cid in [chat_id] if chat_id is not None else list(self._buffers):
+            lock = self._locks.setdefault(cid, asyncio.Lock())
+            async with lock:
+                batch = self._buffers.pop(cid, None)
+                if not batch:
+                    continue
+                try:
+                    await self._store.add_messages(batch)
+                except ValueError as e:
+                    # The chat no longer exists (deleted mid-turn); retrying can't succeed.
+                    import logging
+
+                    logging.getLogger("uvicorn.error").warning(
+                        "Dropping %d buffered messages: %s", len(batch), e
+                    )
+                    metrics.inc("write_behind_dropped", len(batch))
+                except Exception:
+                    # Put the batch back in front of anything enqueued meanwhile; retried on the next tick.
+                    self._buffers[cid] = batch + self._buffers.get(cid, [])
+                    raise
+
+    def discard(self, chat_id: str) -> None:
+        """Drop buffered messages for a deleted chat."""
+        self._buffers.pop(chat_id, None)
+        self._locks.pop(chat_id, None)
+
+    async def _flush_logged(self, chat_id: str | None = None) -> None:
+        import logging
+
+        try:
+            await self.flush(chat_id)
+        except Exception as e:
+            logging.getLogger("uvicorn.error").warning(
+                "Write-behind flush failed (%s); will retry", e
+            )
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self._flush_logged()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the timer and write out everything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
 
 
 # Set in lifespan; use InMemoryChatStore() until then for type hints
 chat_store: ChatStoreProtocol = InMemoryChatStore()
+# "block" stores every streamed TextBlock as its own row; "turn" stores one row per
+# assistant turn, written when the turn's result (or error) arrives.
+ASSISTANT_PERSIST_MODE = os.environ.get("ASSISTANT_PERSIST_MODE", "block").strip().lower()
+# Set in lifespan when WRITE_BEHIND is enabled; None means assistant messages are written inline
+persister: WriteBehindPersister | None = None
+
+
+async def _add_assistant_message(chat_id: str, content: str) -> ChatMessage:
+    if persister is not None:
+        return persister.enqueue(chat_id, "assistant", content)
+    return await chat_store.add_message(chat_id, "assistant", content)
+
+
+# Writes started outside a request (see _save_in_background); referenced until done
+_background_writes: set[asyncio.Task[None]] = set()
+
+
+def _save_in_background(chat_id: str, content: str) -> None:
+    """Store an assistant message without awaiting it; failures are logged, not raised."""
+
+    async def save() -> None:
+        import logging
+
+        try:
+            await _add_assistant_message(chat_id, content)
+        except Exception as e:
+            logging.getLogger("uvicorn.error").warning(
+                "Could not store unfinished turn text for chat %s: %s", chat_id, e
+            )
+
+    task = asyncio.create_task(save())
+    _background_writes.add(task)
+    task.add_done_callback(_background_writes.discard)
+
+
+async def _flush_pending(chat_id: str) -> None:
+    """Make buffered writes for chat_id visible before reading history."""
+    if persister is not None:
+        await persister.flush(chat_id)
+
+# Messages per `history` frame when subscribe doesn't ask for a specific limit
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "50"))
+MAX_HISTORY_PAGE_SIZE = 1000
+
+
+def _page_limit(value: Any) -> int:
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return min(value, MAX_HISTORY_PAGE_SIZE)
+    return HISTORY_PAGE_SIZE
+
+
+async def _history_frame(
+    chat_id: str,
+    before: str | None = None,
+    after: str | None = None,
+    after_seq: int | None = None,
+    limit: int = HISTORY_PAGE_SIZE,
+) -> dict[str, Any]:
+    """
+    One page of history; fetches one extra row to tell whether more exist.
+    With `after`/`after_seq` it is a delta for a reconnecting client; if the
+    `after` message is unknown the newest page is sent with reset=True instead.
+    """
+    await _flush_pending(chat_id)
+    forward = after is not None or after_seq is not None
+    reset = False
+    try:
+        messages = await chat_store.get_messages(
+            chat_id, before=before, after=after, after_seq=after_seq, limit=limit + 1
+        )
+    except ValueError:
+        if after is None or before is not None:
+            raise
+        messages = await chat_store.get_messages(chat_id, limit=limit + 1)
+        forward, reset = False, True
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[:limit] if forward else messages[1:]
+    frame = {
+        "type": "history",
+        "messages": [asdict(m) for m in messages],
+        "hasMore": has_more,
+        "chatId": chat_id,
+    }
+    if reset:
+        frame["reset"] = True
+    return frame
+
+
+# Events kept per session for replay to reconnecting subscribers (count and total size)
+EVENT_REPLAY_BUFFER = int(os.environ.get("EVENT_REPLAY_BUFFER", "500"))
+EVENT_REPLAY_MAX_BYTES = int(os.environ.get("EVENT_REPLAY_MAX_BYTES", str(1024 * 1024)))
+
 
 # Friendly status messages when the agent uses a tool (sent over WebSocket before tool_use)
 AGENT_STATUS_BY_TOOL: dict[str, str] = {
@@ -165,23 +466,122 @@ AGENT_STATUS_BY_TOOL: dict[str, str] = {
 }
 
 
+# Encoded events start with their type (payloads are built type-first)
+_DELTA_PREFIX = encode_event({"type": "assistant_delta"})[:-1]
+
+
 def _agent_status_message(tool_name: str) -> str:
     return AGENT_STATUS_BY_TOOL.get(tool_name, f"Using {tool_name}")
 
 
 # --- Session: one chat = one agent + subscribers ---
 
+# Started in lifespan; AGENT_POOL_SIZE=0 (default) means every agent starts cold
+agent_pool = AgentPool()
+
+
+async def chat_system_prompt(chat_id: str) -> str | None:
+    """
+    Hook for chat-specific agent instructions, applied before the chat's first
+    message (appended to the system prompt, or prefixed to the first message for
+    a pre-started agent). None by default.
+    """
+    return None
+
 
 class Session:
     def __init__(self, chat_id: str) -> None:
         self.chat_id = chat_id
-        self._subscribers: set[Any] = set()
-        self._agent = AgentSession()
+        self._subscribers: set[Connection] = set()
+        # Created on the first message; None again while hibernated (see hibernate())
+        self._agent: AgentSession | None = None
+        # SDK session id last stored for this chat (set when the agent is created)
+        self._stored_agent_session_id: str | None = None
         self._listening: asyncio.Task[None] | None = None
         self._is_listening = False
+        # Text blocks of the current turn, when ASSISTANT_PERSIST_MODE == "turn"
+        self._turn_text: list[str] = []
+        # Same for the chat's research run, which has its own agent and result
+        self._research_text: list[str] = []
+        # User messages whose result hasn't arrived yet: the one at the agent plus _queued
+        self._turns_in_flight = 0
+        # Stored and echoed messages waiting for the agent; _run_turns hands them over
+        # one turn at a time, so the agent slot can change hands between turns
+        self._queued: deque[str] = deque()
+        self._runner: asyncio.Task[None] | None = None
+        # Set when the turn at the agent has been answered (or the agent's stream ended)
+        self._turn_done = asyncio.Event()
+        self.last_active = time.monotonic()
+        # Recent (seq, frame, droppable) for subscribe `lastSeq` replay
+        self._events: deque[tuple[int, str, bool]] = deque()
+        self._events_bytes = 0
+        # seq of the last event delivered here. Seeded from the clock so it keeps
+        # increasing when the session is rebuilt.
+        self.seq = time.time_ns() // 1_000_000
+        # Names this numbering: every process (and every rebuild) numbers events on
+        # its own, so a lastSeq only means something to the session that issued it
+        self.stream = uuid.uuid4().hex[:12]
+        # Orders user messages: stored, echoed and handed to the agent in one go
+        self._send_lock = asyncio.Lock()
+        # send_message tasks started by submit(), stopped by cancel()
+        self._sends: set[asyncio.Task[None]] = set()
+
+    @property
+    def is_idle(self) -> bool:
+        """No subscribers, no turn or research run in flight: safe to close and rebuild later."""
+        return (
+            not self._subscribers
+            and self._turns_in_flight == 0
+            and not research_jobs.is_running(self.chat_id)
+        )
+
+    @property
+    def has_agent(self) -> bool:
+        return self._agent is not None
+
+    @property
+    def holds_agent_slot(self) -> bool:
+        return self._agent is not None and self._agent.has_slot
+
+    async def _ensure_agent(self) -> AgentSession:
+        """The chat's agent, resuming its stored SDK session if it was hibernated."""
+        if self._agent is not None and not self._agent.alive:
+            self.drop_agent()  # its process ended (e.g. an error); start over
+        if self._agent is None:
+            resume = await chat_store.get_agent_session_id(self.chat_id)
+            if resume:
+                self._agent = AgentSession(resume=resume)
+                metrics.inc("agents_resumed")
+            else:
+                self._agent = agent_pool.checkout()
+            # A resumed agent isn't started yet, so this goes into its system prompt again
+            self._agent.bind(await chat_system_prompt(self.chat_id))
+            self._stored_agent_session_id = resume
+        if not self._agent.has_slot:
+            waited = not agent_slots.available
+            if waited:
+                await self._broadcast(
+                    {
+                        "type": "agent_status",
+                        "message": "Waiting for a free agent",
+                        "queued": True,
+                        "chatId": self.chat_id,
+                    }
+                )
+            await self._agent.reserve(self.chat_id)
+            if waited:
+                await self._broadcast(
+                    {
+                        "type": "agent_status",
+                        "message": "Starting agent",
+                        "queued": False,
+                        "chatId": self.chat_id,
+                    }
+                )
+        return self._agent
 
     async def _listen(self) -> None:
-        if self._is_listening:
+        if self._is_listening or self._agent is None:
             return
         self._is_listening = True
         try:
@@ -195,71 +595,413 @@ class Session:
                             "chatId": self.chat_id,
                         }
                     )
-                await self._broadcast(await self._wrap(msg))
+                await self.publish(msg)
+                if msg.get("type") in ("result", "error"):
+                    self._turn_done.set()
         except asyncio.CancelledError:
             pass
         except Exception as e:
             await self._broadcast(
                 {"type": "error", "error": str(e), "chatId": self.chat_id}
             )
+        finally:
+            # The agent's stream has ended; nothing more will arrive for its turn.
+            self._turns_in_flight = len(self._queued)
+            self._turn_done.set()
 
-    async def _wrap(self, msg: dict[str, Any]) -> dict[str, Any]:
+    async def _wrap(self, msg: dict[str, Any], research: bool = False) -> dict[str, Any]:
         out = {**msg, "chatId": self.chat_id}
-        if msg.get("type") == "assistant_message":
-            await chat_store.add_message(
-                self.chat_id, "assistant", msg.get("content", "")
-            )
+        t = msg.get("type")
+        text = self._research_text if research else self._turn_text
+        stored: ChatMessage | None = None
+        if t == "assistant_message":
+            if ASSISTANT_PERSIST_MODE == "turn":
+                text.append(msg.get("content", ""))
+            else:
+                stored = await _add_assistant_message(self.chat_id, msg.get("content", ""))
+        elif t in ("result", "error"):
+            if not research:
+                self._turns_in_flight = max(self._turns_in_flight - 1, 0)
+                self.last_active = time.monotonic()
+                await self._store_agent_session_id(t == "error")
+            if text:
+                content = "\n\n".join(text)
+                text.clear()
+                stored = await _add_assistant_message(self.chat_id, content)
+        if stored is not None:
+            # Lets clients resume with subscribe `after` (messageSeq is unknown until a write-behind flush)
+            out["messageId"] = stored.id
+            if stored.seq:
+                out["messageSeq"] = stored.seq
         return out
 
+    async def _store_agent_session_id(self, failed: bool) -> None:
+        """Remember the SDK session so a hibernated chat can resume it."""
+        agent = self._agent
+        if agent is None:
+            return
+        session_id = agent.session_id
+        if session_id is None:
+            if not (failed and agent.resumed):
+                return
+            # The stored session could not be resumed; start fresh next time
+        elif session_id == self._stored_agent_session_id:
+            return
+        await chat_store.set_agent_session_id(self.chat_id, session_id)
+        self._stored_agent_session_id = session_id
+
     async def _broadcast(self, payload: dict[str, Any]) -> None:
-        dead = []
-        for ws in self._subscribers:
-            try:
-                await ws.send_json(payload)
-            except Exception:
-                dead.append(ws)
-        for c in dead:
-            self._subscribers.discard(c)
+        # Encode once for all subscribers; large tool_use inputs are expensive to serialize.
+        # send() only enqueues, so a slow subscriber can't hold up the others.
+        # Goes through the pub/sub so subscribers on other processes get it too.
+        text = encode_event(payload)
+        droppable = payload.get("type") in DROPPABLE_EVENT_TYPES
+        await pubsub.publish(self.chat_id, text, droppable)
+
+    def deliver(self, text: str, droppable: bool) -> None:
+        """
+        Sequence an encoded event, keep it for replay and queue it to this
+        process's subscribers. Events are numbered in the order they reach
+        here, so seq has no gaps and subscribers can spot dropped frames.
+        """
+        self.seq += 1
+        frame = f'{{"seq":{self.seq},{text[1:]}'  # text is a JSON object
+        if not text.startswith(_DELTA_PREFIX):
+            # Partial text is superseded by its assistant_message; don't let it crowd the buffer
+            self._events.append((self.seq, frame, droppable))
+            self._events_bytes += len(frame)
+        while len(self._events) > EVENT_REPLAY_BUFFER or (
+            self._events_bytes > EVENT_REPLAY_MAX_BYTES and len(self._events) > 1
+        ):
+            self._events_bytes -= len(self._events.popleft()[1])
+        dead = [conn for conn in self._subscribers if not conn.send(frame, droppable)]
+        for conn in dead:
+            conn.detach()
+
+    def replay_since(self, last_seq: int) -> list[tuple[str, bool]] | None:
+        """Buffered frames after last_seq, or None if the buffer doesn't reach back that far."""
+        if last_seq == self.seq:
+            return []
+        if not self._events or not (self._events[0][0] - 1 <= last_seq < self.seq):
+            return None
+        return [(frame, droppable) for seq, frame, droppable in self._events if seq > last_seq]
 
     async def broadcast(self, payload: dict[str, Any]) -> None:
         """Send a message to all subscribers (e.g. research stream events)."""
         await self._broadcast(payload)
 
-    async def send_message(self, content: str) -> None:
-        await chat_store.add_message(self.chat_id, "user", content)
-        asyncio.create_task(
-            self._broadcast(
-                {"type": "user_message", "content": content, "chatId": self.chat_id}
-            )
-        )
-        self._agent.send_message(content)
-        if not self._is_listening and self._listening is None:
-            self._listening = asyncio.create_task(self._listen())
+    async def publish(self, msg: dict[str, Any], research: bool = False) -> None:
+        """Persist an agent event if needed, then broadcast it with chatId."""
+        await self._broadcast(await self._wrap(msg, research))
 
-    def subscribe(self, ws: Any) -> None:
-        self._subscribers.add(ws)
+    def submit(self, content: str) -> None:
+        """send_message in the background, so a turn waiting for an agent slot doesn't hold up the socket."""
+        task = asyncio.create_task(self._send_or_report(content))
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
 
-    def unsubscribe(self, ws: Any) -> None:
-        self._subscribers.discard(ws)
+    async def _send_or_report(self, content: str) -> None:
+        try:
+            await self.send_message(content)
+        except Exception as e:
+            import logging
 
-    def close(self) -> None:
-        self._agent.close()
+            logging.getLogger("uvicorn.error").warning(
+                "Could not send a message to chat %s: %s", self.chat_id, e
+            )
+            await self._broadcast(
+                {"type": "error", "error": f"Could not send message: {e}", "chatId": self.chat_id}
+            )
+
+    async def send_message(self, content: str) -> None:
+        # Taken before anything else is awaited, so messages keep the order they were submitted in
+        async with self._send_lock:
+            if not await leases.acquire(self.chat_id):
+                # Another process runs this chat's agent; it stores and broadcasts the message.
+                await pubsub.send_command(self.chat_id, {"type": "chat", "content": content})
+                metrics.inc("chat_messages_forwarded")
+                return
+            # Buffered assistant replies must land before the next user message.
+            await _flush_pending(self.chat_id)
+            stored = await chat_store.add_message(self.chat_id, "user", content)
+            # Echo before the agent sees the message, so the echo precedes every reply event.
+            await self._broadcast(
+                {
+                    "type": "user_message",
+                    "content": content,
+                    "messageId": stored.id,
+                    "messageSeq": stored.seq,
+                    "chatId": self.chat_id,
+                }
+            )
+            self._queued.append(content)
+            self._turns_in_flight += 1
+            self.last_active = time.monotonic()
+            if self._runner is None or self._runner.done():
+                self._runner = asyncio.create_task(self._run_turns())
+
+    async def _run_turns(self) -> None:
+        """Hand queued messages to the agent, one turn at a time."""
+        while self._queued:
+            try:
+                agent = await self._ensure_agent()  # may wait for an agent slot
+            except Exception as e:
+                # Nothing reached the agent; drop the waiting messages rather than stall
+                self._queued.clear()
+                self._turns_in_flight = 0
+                await self._broadcast(
+                    {
+                        "type": "error",
+                        "error": f"Could not start the agent: {e}",
+                        "chatId": self.chat_id,
+                    }
+                )
+                return
+            self._turn_done.clear()
+            agent.send_message(self._queued.popleft())
+            if not self._is_listening and self._listening is None:
+                self._listening = asyncio.create_task(self._listen())
+            await self._turn_done.wait()
+            if agent_slots.waiting and self._agent is not None:
+                # Other chats are waiting for an agent slot: hand ours over after every
+                # turn. This chat's next turn queues for a slot behind them.
+                self.drop_agent()
+                metrics.inc("agents_yielded")
+
+    def stop_turns(self) -> None:
+        """Forget messages not yet handed to the agent."""
+        self._queued.clear()
+        if self._runner is not None and not self._runner.done():
+            self._runner.cancel()
+        self._runner = None
+
+    async def cancel(self) -> bool:
+        """
+        Interrupt the turn in flight, along with messages still waiting for the
+        agent or an agent slot. The agent process is closed, which frees its slot;
+        the next message resumes its SDK session. Ends with a cancelled result.
+        """
+        sending = [task for task in self._sends if not task.done()]
+        if not sending and not self._turns_in_flight:
+            return False
+        for task in sending:
+            task.cancel()
+        await asyncio.gather(*sending, return_exceptions=True)
+        async with self._send_lock:
+            runner = self._runner
+            self.stop_turns()
+            if runner is not None:
+                await asyncio.gather(runner, return_exceptions=True)
+            if self._agent is not None:
+                self._agent.close()
+            if self._listening is not None:
+                # Deliver what the agent produced before it was stopped
+                await asyncio.gather(self._listening, return_exceptions=True)
+            metrics.inc("turns_cancelled")
+            # Stores the turn's text ("turn" persist mode) and the SDK session id
+            await self.publish({"type": "result", "success": False, "cancelled": True})
+            self.drop_agent()
+        return True
+
+    def subscribe(self, conn: Connection) -> None:
+        self._subscribers.add(conn)
+        conn.sessions.add(self)
+        self.last_active = time.monotonic()
+
+    def unsubscribe(self, conn: Connection) -> None:
+        self._subscribers.discard(conn)
+        conn.sessions.discard(self)
+        self.last_active = time.monotonic()
+
+    def drop_agent(self) -> None:
+        """Stop the agent and its listener; the next message creates (or resumes) a new one."""
+        if self._agent is not None:
+            agent_pool.checkin(self._agent)  # reused if this chat never messaged it
+            self._agent = None
         if self._listening and not self._listening.done():
             self._listening.cancel()
+        self._listening = None
+        self._is_listening = False
+        if self._turn_text:
+            # The turn will get no result; store the text it produced instead of losing it
+            _save_in_background(self.chat_id, "\n\n".join(self._turn_text))
+            self._turn_text = []
+        self._turns_in_flight = len(self._queued)  # still sent by _run_turns
+
+    def hibernate(self) -> bool:
+        """
+        Close an idle agent process, keeping the session and its subscribers.
+        The conversation lives on in the SDK session stored for the chat.
+        """
+        if (
+            self._agent is None
+            or self._turns_in_flight
+            or self._send_lock.locked()  # a message is on its way to the agent
+            or research_jobs.is_running(self.chat_id)
+        ):
+            return False
+        self.drop_agent()
+        metrics.inc("agents_hibernated")
+        return True
+
+    def close(self, deleted: bool = False) -> None:
+        """Stop the session's work; deleted=True when the chat is gone, so nothing is stored."""
+        if deleted:
+            self._turn_text = []
+        for task in self._sends:
+            task.cancel()
+        for conn in list(self._subscribers):
+            self.unsubscribe(conn)
+        self.stop_turns()
+        self.drop_agent()
+        leases.release(self.chat_id)
+
+
+# Least recently used first. Idle sessions (no subscribers, no turn in flight) are
+# closed after SESSION_IDLE_TTL seconds, or sooner once there are more than
+# MAX_SESSIONS; get_session rebuilds them on the next subscribe/chat.
+sessions: OrderedDict[str, Session] = OrderedDict()
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", "900"))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", "1000"))
+# Seconds without activity after which a session's agent process is closed
+# (hibernated) and resumed from its SDK session on the next message; 0 disables
+AGENT_HIBERNATE_AFTER = float(os.environ.get("AGENT_HIBERNATE_AFTER", "300"))
+# At least a second, so a zero or negative TTL doesn't turn the reaper into a busy loop
+SESSION_REAP_INTERVAL = max(
+    1.0,
+    min(30.0, SESSION_IDLE_TTL / 2, AGENT_HIBERNATE_AFTER / 2 or SESSION_IDLE_TTL),
+)
 
-
-sessions: dict[str, Session] = {}
+metrics.gauge("sessions_live", lambda: len(sessions))
+metrics.gauge("agents_live", lambda: sum(1 for s in sessions.values() if s.has_agent))
 
 
 def get_session(chat_id: str) -> Session:
-    if chat_id not in sessions:
-        sessions[chat_id] = Session(chat_id)
-    return sessions[chat_id]
+    session = sessions.get(chat_id)
+    if session is None:
+        session = sessions[chat_id] = Session(chat_id)
+        metrics.inc("sessions_created")
+        _evict_over_capacity(keep=chat_id)
+    else:
+        sessions.move_to_end(chat_id)
+    return session
+
+
+def _evict_session(chat_id: str, reason: str) -> None:
+    session = sessions.pop(chat_id, None)
+    if session is not None:
+        session.close()
+        metrics.inc(f"sessions_evicted_{reason}")
+
+
+def _evict_over_capacity(keep: str) -> None:
+    excess = len(sessions) - MAX_SESSIONS
+    if excess <= 0:
+        return
+    victims = []
+    for chat_id, session in sessions.items():
+        if len(victims) == excess:
+            break
+        if session.is_idle and chat_id != keep:
+            victims.append(chat_id)
+    for chat_id in victims:
+        _evict_session(chat_id, "lru")
+
+
+async def _reap_idle_sessions() -> None:
+    while True:
+        await asyncio.sleep(SESSION_REAP_INTERVAL)
+        now = time.monotonic()
+        cutoff = now - SESSION_IDLE_TTL
+        for chat_id in [
+            cid for cid, s in sessions.items() if s.is_idle and s.last_active < cutoff
+        ]:
+            _evict_session(chat_id, "idle")
+        if AGENT_HIBERNATE_AFTER > 0:
+            cutoff = now - AGENT_HIBERNATE_AFTER
+            for session in sessions.values():
+                if session.has_agent and session.last_active < cutoff:
+                    session.hibernate()
+
+
+def _reclaim_idle_agent() -> bool:
+    """Hibernate the least recently used idle chat agent to free its slot (AgentSlots)."""
+    for session in list(sessions.values()):
+        if session.holds_agent_slot and session.hibernate():
+            metrics.inc("agents_reclaimed")
+            return True
+    return False
+
+
+agent_slots.add_reclaimer(_reclaim_idle_agent)
+
+
+async def _publish_research_event(chat_id: str, event: dict[str, Any]) -> None:
+    await get_session(chat_id).publish(event, research=True)
+
+
+# "local": run research in this process. "queue": enqueue for worker.py (needs DATABASE_URL).
+RESEARCH_EXECUTOR = os.environ.get("RESEARCH_EXECUTOR", "local").strip().lower()
+research_jobs: ResearchJobs | QueuedResearchJobs = ResearchJobs(_publish_research_event)
+
+
+def _deliver(chat_id: str, text: str, droppable: bool) -> None:
+    # Only chats with a live session here can have subscribers here
+    session = sessions.get(chat_id)
+    if session is not None:
+        session.deliver(text, droppable)
+
+
+def _handle_command(chat_id: str, command: dict[str, Any]) -> None:
+    """A message forwarded by a process that doesn't own chat_id."""
+    if command.get("type") == "chat" and leases.holds(chat_id):
+        get_session(chat_id).submit(command.get("content", ""))
+    elif command.get("type") == "cancel":
+        asyncio.create_task(_cancel_here(chat_id))
+
+
+async def _cancel_here(chat_id: str) -> bool:
+    """Stop the chat's turn and research run if they execute in this process."""
+    session = sessions.get(chat_id)
+    turn = session is not None and await session.cancel()
+    research = await research_jobs.cancel(chat_id)
+    return turn or research
+
+
+def _on_leases_lost(chat_ids: list[str]) -> None:
+    # Another process may take these chats over now; stop our agents for them.
+    for chat_id in chat_ids:
+        session = sessions.get(chat_id)
+        if session is not None:
+            session.stop_turns()
+            session.drop_agent()
+    metrics.inc("chat_leases_lost", len(chat_ids))
+
+
+# "local": events reach this process's subscribers only.
+# "postgres": LISTEN/NOTIFY fan-out and chat leases across processes (needs DATABASE_URL).
+PUBSUB = os.environ.get("PUBSUB", "local").strip().lower()
+pubsub: PubSubProtocol = LocalPubSub(_deliver, _handle_command)
+leases: ChatLeasesProtocol = LocalChatLeases()
+metrics.gauge("chat_leases_held", lambda: leases.held_count)
 
 
 # --- REST ---
 
 
+def _owner_redirect(request: Request, chat_id: str) -> RedirectResponse | None:
+    """
+    With --workers, send chat requests that touch the owner's in-memory state
+    (its session, agent and write-behind buffer) to the owner's direct port.
+    307 keeps the method, so a DELETE is repeated there.
+    """
+    port = redirect_port(chat_id)
+    if port is None:
+        return None
+    metrics.inc("rest_redirects")
+    return RedirectResponse(str(request.url.replace(port=port)), status_code=307)
+
+
 class CreateChatBody(BaseModel):
     title: str | None = None
 
@@ -269,6 +1011,11 @@ def root():
     return {"message": "Hello from at-backend!"}
 
 
+@app.get("/api/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
+
 @app.get("/api/chats")
 async def list_chats():
     return await chat_store.get_all_chats()
@@ -288,18 +1035,38 @@ async def get_chat(chat_id: str):
 
 
 @app.delete("/api/chats/{chat_id}")
-async def delete_chat(chat_id: str):
+async def delete_chat(request: Request, chat_id: str):
+    if (redirect := _owner_redirect(request, chat_id)) is not None:
+        return redirect
+    if persister is not None:
+        persister.discard(chat_id)
     if not await chat_store.delete_chat(chat_id):
         raise HTTPException(status_code=404, detail="Chat not found")
     if chat_id in sessions:
-        sessions[chat_id].close()
-        del sessions[chat_id]
+        sessions.pop(chat_id).close(deleted=True)
+    if persister is not None:
+        persister.discard(chat_id)  # anything its listener buffered before the close
     return {"success": True}
 
 
 @app.get("/api/chats/{chat_id}/messages")
-async def get_messages(chat_id: str):
-    return await chat_store.get_messages(chat_id)
+async def get_messages(
+    request: Request,
+    chat_id: str,
+    before: str | None = None,
+    after: str | None = None,
+    after_seq: int | None = Query(None, ge=0),
+    limit: int | None = Query(None, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+):
+    if (redirect := _owner_redirect(request, chat_id)) is not None:
+        return redirect
+    await _flush_pending(chat_id)
+    try:
+        return await chat_store.get_messages(
+            chat_id, before=before, after=after, after_seq=after_seq, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 # --- WebSocket ---
@@ -308,9 +1075,10 @@ async def get_messages(chat_id: str):
 @app.websocket("/ws")
 async def ws(websocket: WebSocket):
     await websocket.accept()
-    await websocket.send_json(
-        {"type": "connected", "message": "Connected to chat server"}
-    )
+    # Every outbound frame goes through conn so replies stay ordered with broadcasts.
+    conn = Connection(websocket)
+    conn.start()
+    conn.send_json({"type": "connected", "message": "Connected to chat server"})
     try:
         while True:
             data = await websocket.receive_json()
@@ -318,57 +1086,113 @@ async def ws(websocket: WebSocket):
             if isinstance(t, str):
                 t = t.strip().lower()
             chat_id = data.get("chatId", "")
-            if t == "subscribe":
+            port = redirect_port(chat_id) if t in ("subscribe", "chat", "research", "cancel") else None
+            if port is not None:
+                # Another worker owns this chat; the client reconnects there for it.
+                conn.send_json({"type": "redirect", "chatId": chat_id, "port": port})
+                metrics.inc("ws_redirects")
+            elif t == "subscribe":
                 session = get_session(chat_id)
-                session.subscribe(websocket)
-                messages = await chat_store.get_messages(chat_id)
-                await websocket.send_json(
-                    {"type": "history", "messages": messages, "chatId": chat_id}
-                )
+                last_seq = data.get("lastSeq", data.get("lastEventId"))
+                replay = None
+                if isinstance(last_seq, int):
+                    if data.get("stream") == session.stream:
+                        replay = session.replay_since(last_seq)
+                    else:
+                        # Numbered by another process or an earlier session: can't be matched
+                        metrics.inc("subscribe_replays_foreign")
+                # No await between the snapshot and subscribing: nothing is missed or sent twice.
+                session.subscribe(conn)
+                if replay is not None:
+                    conn.send_json(
+                        {
+                            "type": "replay",
+                            "count": len(replay),
+                            "stream": session.stream,
+                            "chatId": chat_id,
+                        }
+                    )
+                    for frame, droppable in replay:
+                        conn.send(frame, droppable)
+                    metrics.inc("subscribe_replays")
+                    continue
+                subscribed_at = session.seq
+                try:
+                    after_seq = data.get("afterSeq")
+                    frame = await _history_frame(
+                        chat_id,
+                        before=data.get("before"),
+                        after=data.get("after"),
+                        after_seq=after_seq if isinstance(after_seq, int) else None,
+                        limit=_page_limit(data.get("limit")),
+                    )
+                    # Resume point for lastSeq; later events reach this connection live
+                    frame["seq"] = subscribed_at
+                    frame["stream"] = session.stream
+                except ValueError as e:
+                    frame = {"type": "error", "error": str(e), "chatId": chat_id}
+                conn.send_json(frame)
             elif t == "chat":
                 session = get_session(chat_id)
-                session.subscribe(websocket)
-                await session.send_message(data.get("content", ""))
+                session.subscribe(conn)
+                session.submit(data.get("content", ""))
+            elif t == "cancel":
+                get_session(chat_id).subscribe(conn)
+                await _cancel_here(chat_id)
+                if not isinstance(pubsub, LocalPubSub):
+                    # The turn or research run may be on another process (or a research worker)
+                    await pubsub.send_command(chat_id, {"type": "cancel"})
             elif t == "research":
                 session = get_session(chat_id)
-                session.subscribe(websocket)
+                session.subscribe(conn)
                 topic = data.get("topic") or ""
                 repo_name = data.get("repo_name")
                 if not topic:
-                    await websocket.send_json(
+                    conn.send_json(
                         {"type": "error", "error": "Missing topic", "chatId": chat_id}
                     )
                 else:
-                    from test import ResearchProjectAgent
-                    agent = ResearchProjectAgent()
                     try:
-                        async for event in agent.run_research_stream(topic, repo_name):
-                            payload = {**event, "chatId": chat_id}
-                            if event.get("type") == "assistant_message":
-                                await chat_store.add_message(
-                                    chat_id, "assistant", event.get("content", "")
-                                )
-                            await session.broadcast(payload)
+                        started = await research_jobs.start(chat_id, topic, repo_name)
+                        error = "Research is already running for this chat"
                     except Exception as e:
-                        await session.broadcast(
-                            {"type": "error", "error": str(e), "chatId": chat_id}
+                        started, error = False, f"Could not start research: {e}"
+                    if not started:
+                        conn.send_json(
+                            {"type": "error", "error": error, "chatId": chat_id}
                         )
             else:
                 import logging
                 logging.getLogger("uvicorn.error").warning(
                     "WebSocket unknown message type: %r (keys: %s)", t, list(data.keys()) if isinstance(data, dict) else "not a dict"
                 )
-                await websocket.send_json(
-                    {"type": "error", "error": "Invalid message format"}
-                )
+                conn.send_json({"type": "error", "error": "Invalid message format"})
     except WebSocketDisconnect:
         pass
     finally:
-        for s in sessions.values():
-            s.unsubscribe(websocket)
+        # Only the sessions this socket joined, not every session in the process
+        conn.close()
+        conn.detach()
 
 
 if __name__ == "__main__":
+    import argparse
+
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    parser = argparse.ArgumentParser(description="at-backend API server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("WORKERS", "1")),
+        help="Worker processes sharing the port; chats are routed to workers by hash",
+    )
+    args = parser.parse_args()
+    if args.workers > 1:
+        import cluster
+
+        cluster.serve("main:app", args.host, args.port, args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,67 @@
+"""
+In-process metrics: counters, gauges and latency summaries.
+Served as JSON by GET /api/metrics; names are flat strings like "sessions_evicted_idle".
+"""
+
+from __future__ import annotations
+
+import statistics
+from collections import deque
+from collections.abc import Callable
+from typing import Any
+
+# Samples kept per summary for percentiles
+SUMMARY_WINDOW = 1000
+
+_counters: dict[str, float] = {}
+_gauges: dict[str, float | Callable[[], float]] = {}
+_summaries: dict[str, _Summary] = {}
+
+
+class _Summary:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: deque[float] = deque(maxlen=SUMMARY_WINDOW)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def snapshot(self) -> dict[str, float]:
+        recent = sorted(self.recent)
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": statistics.median(recent) if recent else 0.0,
+            "p95": recent[max(int(len(recent) * 0.95) - 1, 0)] if recent else 0.0,
+            "max": self.max,
+        }
+
+
+def inc(name: str, value: float = 1) -> None:
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name: str, value: float | Callable[[], float]) -> None:
+    """Set a gauge; a callable is evaluated on every snapshot."""
+    _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    """Record one sample (e.g. a latency in ms) in the named summary."""
+    summary = _summaries.get(name)
+    if summary is None:
+        summary = _summaries[name] = _Summary()
+    summary.observe(value)
+
+
+def snapshot() -> dict[str, Any]:
+    return {
+        "counters": dict(_counters),
+        "gauges": {k: v() if callable(v) else v for k, v in _gauges.items()},
+        "summaries": {k: s.snapshot() for k, s in _summaries.items()},
+    }
@@ -0,0 +1,48 @@
+"""
+Per-chat event fan-out between processes.
+
+Session._broadcast publishes every encoded event here; the pub/sub delivers it
+to this process's subscribers and, with the Postgres implementation
+(db.PostgresPubSub), to every other process listening on the same database.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable
+from typing import Any, Protocol
+
+# deliver(chat_id, text, droppable): hand an encoded event to local subscribers
+Deliver = Callable[[str, str, bool], None]
+# on_command(chat_id, command): a command forwarded to the chat's owner (e.g. a `chat` message)
+OnCommand = Callable[[str, dict[str, Any]], None]
+
+
+class PubSubProtocol(Protocol):
+    async def start(self) -> None: ...
+
+    async def publish(self, chat_id: str, text: str, droppable: bool = False) -> None: ...
+
+    async def send_command(self, chat_id: str, command: dict[str, Any]) -> None: ...
+
+    async def close(self) -> None: ...
+
+
+class LocalPubSub:
+    """Single process: publishing is local delivery."""
+
+    def __init__(self, deliver: Deliver, on_command: OnCommand | None = None) -> None:
+        self._deliver = deliver
+        self._on_command = on_command
+
+    async def start(self) -> None:
+        pass
+
+    async def publish(self, chat_id: str, text: str, droppable: bool = False) -> None:
+        self._deliver(chat_id, text, droppable)
+
+    async def send_command(self, chat_id: str, command: dict[str, Any]) -> None:
+        if self._on_command is not None:
+            self._on_command(chat_id, command)
+
+    async def close(self) -> None:
+        pass
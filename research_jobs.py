@@ -0,0 +1,403 @@
+"""
+Background research runs: at most one ResearchProjectAgent job per chat.
+Jobs are started from the WebSocket handler and tracked here, so the receive loop
+returns immediately and a run outlives the connection that started it.
+At most MAX_CONCURRENT_RESEARCH runs execute at once; the rest wait in FIFO order
+(one job per chat, so FIFO is also fair across chats) and are told their position.
+
+Every job is recorded in a job store (the research_jobs table with Postgres) and
+heartbeated by the process running it. Jobs whose heartbeat goes stale (crash,
+deploy) are claimed by a live process and resumed from their last phase.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Protocol
+
+import metrics
+
+MAX_CONCURRENT_RESEARCH = int(os.environ.get("MAX_CONCURRENT_RESEARCH", "2"))
+# Seconds between heartbeats; a job without one for RESEARCH_ORPHAN_TIMEOUT is orphaned
+RESEARCH_HEARTBEAT_INTERVAL = float(os.environ.get("RESEARCH_HEARTBEAT_INTERVAL", "15"))
+RESEARCH_ORPHAN_TIMEOUT = float(os.environ.get("RESEARCH_ORPHAN_TIMEOUT", "60"))
+# Runs (first attempt included) before an orphaned job is failed instead of resumed
+MAX_RESEARCH_ATTEMPTS = int(os.environ.get("MAX_RESEARCH_ATTEMPTS", "3"))
+
+# Identifies this process in research_jobs.worker_id
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+ACTIVE_STATUSES = ("queued", "running")
+# Fields update_job may change
+UPDATABLE_JOB_FIELDS = {"status", "phase", "repo_name", "repo_url", "cost", "error"}
+
+logger = logging.getLogger("uvicorn.error")
+
+# publish(chat_id, event): persist/broadcast one run_research_stream event
+Publish = Callable[[str, dict[str, Any]], Awaitable[None]]
+
+
+@dataclass
+class ResearchJob:
+    id: str
+    chat_id: str
+    topic: str
+    repo_name: str | None
+    status: str  # queued | running | succeeded | failed | cancelled
+    phase: str  # queued | repo | agent | done (see run_research_stream)
+    created_at: str
+    repo_url: str | None = None
+    cost: float | None = None
+    error: str | None = None
+    worker_id: str | None = None
+    attempts: int = 1
+    started_at: str | None = None
+    heartbeat_at: str | None = None
+    finished_at: str | None = None
+
+
+class ResearchJobStoreProtocol(Protocol):
+    async def create_job(
+        self, chat_id: str, topic: str, repo_name: str | None, worker_id: str
+    ) -> ResearchJob | None: ...
+    async def update_job(self, job_id: str, **fields: Any) -> None: ...
+    async def heartbeat(self, worker_id: str) -> None: ...
+    async def claim_orphans(
+        self, worker_id: str, stale_after: float
+    ) -> list[ResearchJob]: ...
+    async def release(self, worker_id: str) -> None: ...
+
+
+class InMemoryResearchJobStore:
+    """Job store for the in-memory setup; nothing survives a restart, so nothing is orphaned."""
+
+    def __init__(self) -> None:
+        self._jobs: dict[str, ResearchJob] = {}
+
+    async def create_job(
+        self, chat_id: str, topic: str, repo_name: str | None, worker_id: str
+    ) -> ResearchJob | None:
+        """New queued job, or None if the chat already has an active one."""
+        if any(
+            j.chat_id == chat_id and j.status in ACTIVE_STATUSES
+            for j in self._jobs.values()
+        ):
+            return None
+        now = datetime.now(timezone.utc).isoformat()
+        job = ResearchJob(
+            id=uuid.uuid4().hex,
+            chat_id=chat_id,
+            topic=topic,
+            repo_name=repo_name,
+            status="queued",
+            phase="queued",
+            created_at=now,
+            worker_id=worker_id,
+            heartbeat_at=now,
+        )
+        self._jobs[job.id] = job
+        return job
+
+    async def update_job(self, job_id: str, **fields: Any) -> None:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        for key, value in fields.items():
+            if key in UPDATABLE_JOB_FIELDS:
+                setattr(job, key, value)
+        if fields.get("status") == "running":
+            job.started_at = job.started_at or now
+        elif fields.get("status") not in (None, *ACTIVE_STATUSES):
+            job.finished_at = now
+
+    async def heartbeat(self, worker_id: str) -> None:
+        now = datetime.now(timezone.utc).isoformat()
+        for job in self._jobs.values():
+            if job.worker_id == worker_id and job.status in ACTIVE_STATUSES:
+                job.heartbeat_at = now
+
+    async def claim_orphans(
+        self, worker_id: str, stale_after: float
+    ) -> list[ResearchJob]:
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=stale_after)).isoformat()
+        claimed = []
+        for job in self._jobs.values():
+            unclaimed = job.status == "queued" and job.worker_id is None
+            if (
+                job.status in ACTIVE_STATUSES
+                and not unclaimed
+                and (job.heartbeat_at is None or job.heartbeat_at < cutoff)
+            ):
+                job.worker_id = worker_id
+                job.heartbeat_at = datetime.now(timezone.utc).isoformat()
+                job.attempts += 1
+                claimed.append(job)
+        return claimed
+
+    async def release(self, worker_id: str) -> None:
+        for job in self._jobs.values():
+            if job.worker_id == worker_id and job.status in ACTIVE_STATUSES:
+                job.heartbeat_at = None
+
+
+class ResearchJobs:
+    """Registry of running research jobs, keyed by chat id."""
+
+    def __init__(
+        self,
+        publish: Publish,
+        max_concurrent: int = MAX_CONCURRENT_RESEARCH,
+        store: ResearchJobStoreProtocol | None = None,
+    ) -> None:
+        self._publish = publish
+        self._max_concurrent = max_concurrent
+        # Replaced with the Postgres store in lifespan when DATABASE_URL is set
+        self.store: ResearchJobStoreProtocol = store or InMemoryResearchJobStore()
+        self._tasks: dict[str, asyncio.Task[None]] = {}
+        self._active = 0
+        self._waiting: deque[tuple[str, asyncio.Future[None]]] = deque()
+        self._heartbeat: asyncio.Task[None] | None = None
+        # Chats whose run is being stopped by cancel() rather than by shutdown
+        self._cancelling: set[str] = set()
+        metrics.gauge("research_running", lambda: self._active)
+        metrics.gauge("research_queued", lambda: len(self._waiting))
+
+    def is_running(self, chat_id: str) -> bool:
+        return chat_id in self._tasks
+
+    @property
+    def has_capacity(self) -> bool:
+        """True while fewer jobs are running or waiting here than the concurrency limit."""
+        return len(self._tasks) < self._max_concurrent
+
+    def run(self, job: ResearchJob) -> None:
+        """Run an already-recorded job (claimed from the queue by worker.py)."""
+        if job.chat_id not in self._tasks:
+            self._spawn(job)
+
+    async def start(self, chat_id: str, topic: str, repo_name: str | None = None) -> bool:
+        """Record and start a run in the background. Returns False if the chat already has one."""
+        if chat_id in self._tasks:
+            return False
+        job = await self.store.create_job(chat_id, topic, repo_name, WORKER_ID)
+        if job is None or chat_id in self._tasks:
+            return False
+        self._spawn(job)
+        return True
+
+    async def cancel(self, chat_id: str) -> bool:
+        """Stop the chat's run, queued or running. It is recorded as cancelled and ends with a cancelled result."""
+        task = self._tasks.get(chat_id)
+        if task is None or task.done():
+            return False
+        self._cancelling.add(chat_id)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    def _spawn(self, job: ResearchJob, resume_repo_url: str | None = None) -> None:
+        self._tasks[job.chat_id] = asyncio.create_task(self._run(job, resume_repo_url))
+
+    async def _record(self, job_id: str, **fields: Any) -> None:
+        """Update the job row; a store hiccup must not kill the run."""
+        try:
+            await self.store.update_job(job_id, **fields)
+        except Exception as e:
+            logger.warning("Could not update research job %s: %s", job_id, e)
+
+    async def _acquire(self, chat_id: str) -> None:
+        """Wait for a run slot, publishing queue positions while waiting."""
+        if self._active < self._max_concurrent and not self._waiting:
+            self._active += 1
+            return
+        started = time.monotonic()
+        granted: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiting.append((chat_id, granted))
+        await self._announce_positions()
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                await self._release()  # granted just before the cancel landed
+            else:
+                self._waiting = deque(w for w in self._waiting if w[1] is not granted)
+                await self._announce_positions()
+            raise
+        metrics.observe("research_queue_wait_ms", (time.monotonic() - started) * 1000)
+        await self._publish(
+            chat_id,
+            {"type": "agent_status", "message": "Starting research", "queued": False},
+        )
+
+    async def _release(self) -> None:
+        self._active -= 1
+        while self._waiting and self._active < self._max_concurrent:
+            _, granted = self._waiting.popleft()
+            if not granted.done():
+                self._active += 1
+                granted.set_result(None)
+        await self._announce_positions()
+
+    async def _announce_positions(self) -> None:
+        for position, (chat_id, _) in enumerate(list(self._waiting), start=1):
+            try:
+                await self._publish(
+                    chat_id,
+                    {
+                        "type": "agent_status",
+                        "message": f"Waiting for a research slot (position {position} of {len(self._waiting)})",
+                        "queued": True,
+                        "position": position,
+                    },
+                )
+            except Exception:
+                pass
+
+    async def _run(self, job: ResearchJob, resume_repo_url: str | None) -> None:
+        from test import ResearchProjectAgent
+
+        agent = None
+        acquired = False
+        status, error = "failed", None
+
+        async def on_progress(**fields: Any) -> None:
+            await self._record(job.id, **fields)
+
+        try:
+            await self._acquire(job.chat_id)
+            acquired = True
+            await self._record(job.id, status="running")
+            agent = ResearchProjectAgent()
+            await agent.agent.reserve(job.chat_id)  # process-wide agent cap (agent.AgentSlots)
+            async for event in agent.run_research_stream(
+                job.topic,
+                job.repo_name,
+                on_progress=on_progress,
+                resume_repo_url=resume_repo_url,
+            ):
+                if event.get("type") == "result":
+                    status = "succeeded" if event.get("success") else "failed"
+                elif event.get("type") == "error":
+                    error = event.get("error")
+                await self._publish(job.chat_id, event)
+        except asyncio.CancelledError:
+            if job.chat_id not in self._cancelling:
+                # Shutdown: leave the job active so a live process resumes it.
+                status = None
+                raise
+            self._cancelling.discard(job.chat_id)
+            status = "cancelled"
+            if agent is not None:
+                agent.agent.close()  # free the agent slot before publishing
+            metrics.inc("research_cancelled")
+            await self._publish(
+                job.chat_id, {"type": "result", "success": False, "cancelled": True}
+            )
+        except Exception as e:
+            error = str(e)
+            await self._publish(job.chat_id, {"type": "error", "error": error})
+        finally:
+            if agent is not None:
+                agent.agent.close()
+            self._tasks.pop(job.chat_id, None)
+            if status is not None:
+                await self._record(job.id, status=status, error=error)
+            if acquired:
+                await self._release()
+
+    async def recover(self) -> None:
+        """Claim orphaned jobs (stale heartbeat) and resume, finish or fail them."""
+        try:
+            jobs = await self.store.claim_orphans(WORKER_ID, RESEARCH_ORPHAN_TIMEOUT)
+        except Exception as e:
+            logger.warning("Could not look for orphaned research jobs: %s", e)
+            return
+        for job in jobs:
+            metrics.inc("research_jobs_recovered")
+            if job.phase == "done":
+                # The result arrived but the final status write didn't.
+                await self._record(job.id, status="succeeded")
+            elif job.attempts > MAX_RESEARCH_ATTEMPTS or job.chat_id in self._tasks:
+                error = f"Research abandoned after {job.attempts - 1} interrupted attempts"
+                await self._record(job.id, status="failed", error=error)
+                await self._publish(job.chat_id, {"type": "error", "error": error})
+            else:
+                logger.info("Resuming research job %s (phase %s)", job.id, job.phase)
+                await self._publish(
+                    job.chat_id,
+                    {"type": "agent_status", "message": "Resuming research after an interruption"},
+                )
+                # Past the GitHub step the agent continues in the existing repository.
+                self._spawn(job, job.repo_url if job.phase == "agent" else None)
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(RESEARCH_HEARTBEAT_INTERVAL)
+            try:
+                await self.store.heartbeat(WORKER_ID)
+            except Exception as e:
+                logger.warning("Research job heartbeat failed: %s", e)
+            await self.recover()
+
+    async def startup(self) -> None:
+        """Resume jobs orphaned by a previous process and start heartbeating (app startup)."""
+        await self.recover()
+        if self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def shutdown(self) -> None:
+        """Stop running jobs and hand them back for another process to resume (app shutdown)."""
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await self.store.release(WORKER_ID)
+        except Exception as e:
+            logger.warning("Could not release research jobs: %s", e)
+
+
+class QueuedResearchJobs:
+    """
+    API side of RESEARCH_EXECUTOR=queue: start() enqueues the job for worker.py
+    processes, which publish its events through the pub/sub. Same interface as
+    ResearchJobs.
+    """
+
+    def __init__(self, queue: Any, publish: Publish | None = None) -> None:
+        self._queue = queue
+        self._publish = publish
+
+    def is_running(self, chat_id: str) -> bool:
+        return False  # runs on workers; sessions here only receive events
+
+    async def start(self, chat_id: str, topic: str, repo_name: str | None = None) -> bool:
+        job = await self._queue.enqueue_job(chat_id, topic, repo_name)
+        return job is not None
+
+    async def cancel(self, chat_id: str) -> bool:
+        """Cancel a job no worker has claimed yet. A claimed job is stopped by its worker (a `cancel` command)."""
+        if not await self._queue.cancel_unclaimed(chat_id):
+            return False
+        if self._publish is not None:
+            await self._publish(chat_id, {"type": "result", "success": False, "cancelled": True})
+        return True
+
+    async def startup(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        await self._queue.close()
@@ -5,7 +5,9 @@ CREATE TABLE IF NOT EXISTS chats (
     id          TEXT PRIMARY KEY,
     title       TEXT NOT NULL DEFAULT 'New Chat',
     created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_seq    BIGINT NOT NULL DEFAULT 0,  -- seq of the newest message in the chat
+    agent_session_id TEXT  -- Agent SDK session to resume the chat's conversation from
 );
 
 CREATE TABLE IF NOT EXISTS chat_messages (
@@ -13,8 +15,78 @@ CREATE TABLE IF NOT EXISTS chat_messages (
     chat_id     TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
     role        TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
     content     TEXT NOT NULL,
-    timestamp   TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    timestamp   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    seq         BIGINT NOT NULL  -- per-chat order: 1, 2, 3, ... (allocated from chats.last_seq)
 );
 
-CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id ON chat_messages(chat_id);
+-- Migration for databases created before per-chat sequence numbers: number existing
+-- messages by (timestamp, id) within each chat and seed chats.last_seq. Runs once.
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_seq BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS agent_session_id TEXT;
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'chat_messages'
+          AND column_name = 'seq'
+    ) THEN
+        ALTER TABLE chat_messages ADD COLUMN seq BIGINT;
+        UPDATE chat_messages m
+        SET seq = o.seq
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY timestamp, id) AS seq
+            FROM chat_messages
+        ) o
+        WHERE m.id = o.id;
+        ALTER TABLE chat_messages ALTER COLUMN seq SET NOT NULL;
+        UPDATE chats c
+        SET last_seq = m.max_seq
+        FROM (SELECT chat_id, MAX(seq) AS max_seq FROM chat_messages GROUP BY chat_id) m
+        WHERE c.id = m.chat_id;
+    END IF;
+END $$;
+
+-- (chat_id, seq) serves history ordering, keyset pagination and delta fetches;
+-- it also covers lookups by chat_id, so the old single-column index is dropped.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_messages_chat_seq ON chat_messages(chat_id, seq);
+DROP INDEX IF EXISTS idx_chat_messages_chat_id;
 CREATE INDEX IF NOT EXISTS idx_chats_updated_at ON chats(updated_at DESC);
+
+-- Research runs (research_jobs.py). The running process heartbeats its jobs;
+-- active jobs with a stale heartbeat are claimed and resumed by another process.
+CREATE TABLE IF NOT EXISTS research_jobs (
+    id            TEXT PRIMARY KEY,
+    chat_id       TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    topic         TEXT NOT NULL,
+    repo_name     TEXT,
+    repo_url      TEXT,
+    phase         TEXT NOT NULL DEFAULT 'queued',  -- queued, repo, agent, done
+    status        TEXT NOT NULL DEFAULT 'queued'
+                  CHECK (status IN ('queued', 'running', 'succeeded', 'failed', 'cancelled')),
+    cost          DOUBLE PRECISION,
+    error         TEXT,
+    worker_id     TEXT,
+    attempts      INT NOT NULL DEFAULT 1,
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    started_at    TIMESTAMPTZ,
+    heartbeat_at  TIMESTAMPTZ,
+    finished_at   TIMESTAMPTZ
+);
+
+-- One active job per chat
+CREATE UNIQUE INDEX IF NOT EXISTS idx_research_jobs_active_chat
+    ON research_jobs(chat_id) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS idx_research_jobs_active_heartbeat
+    ON research_jobs(heartbeat_at) WHERE status IN ('queued', 'running');
+-- Work queue for worker.py (RESEARCH_EXECUTOR=queue): unclaimed jobs, oldest first
+CREATE INDEX IF NOT EXISTS idx_research_jobs_unclaimed
+    ON research_jobs(created_at) WHERE status = 'queued' AND worker_id IS NULL;
+
+-- Chat events too large for a NOTIFY payload (see db.PostgresPubSub); pruned after a few minutes
+CREATE TABLE IF NOT EXISTS chat_event_spill (
+    id          BIGSERIAL PRIMARY KEY,
+    payload     TEXT NOT NULL,
+    created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_chat_event_spill_created_at ON chat_event_spill(created_at);
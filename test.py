@@ -237,6 +237,16 @@ GIT_WORKFLOW = """\
 10. git branch -M main && git push -u origin main
 """
 
+RESUME_NOTE = """
+
+## Resuming an Interrupted Run
+
+A previous run of this task was interrupted. The repository may already contain
+some or all of the work. Clone it first, check what is already committed and
+pushed, and continue from there; do not start over or recreate existing files
+unless they are broken.
+"""
+
 
 class ResearchProjectAgent:
     def __init__(self):
@@ -388,30 +398,49 @@ Begin now. Start with Phase 1."""
     }
 
     async def run_research_stream(
-        self, topic: str, repo_name: str | None = None
+        self,
+        topic: str,
+        repo_name: str | None = None,
+        on_progress=None,
+        resume_repo_url: str | None = None,
     ):
         """
         Async generator: run research project and yield event dicts for WebSocket.
         Yields: assistant_message, agent_status, tool_use, result, error (each with appropriate keys).
-        Caller should add chatId and broadcast.
+        Caller should add chatId and broadcast. Stops after the turn's result or error.
+
+        on_progress: optional async callback, awaited with keyword fields as the run
+        moves through phases: phase="repo" (GitHub repository), phase="agent" (with
+        repo_url; the LLM is working), phase="done" (with cost).
+        resume_repo_url: repository of an interrupted run; skips the GitHub step and
+        asks the agent to continue from what was already pushed.
         """
+        async def progress(**fields):
+            if on_progress is not None:
+                await on_progress(**fields)
+
         if repo_name is None:
             repo_name = self._sanitize_repo_name(topic)
 
-        try:
-            if self.github.repository_exists(repo_name):
-                repo_url = f"https://github.com/atium-research/{repo_name}"
-            else:
-                repo_url = self.github.create_repository(
-                    repo_name=repo_name,
-                    description=f"Research project: {topic}",
-                    private=False,
-                    auto_init=False,
-                )
-        except Exception as e:
-            yield {"type": "error", "error": f"Failed to create repository: {e}"}
-            return
-
+        if resume_repo_url is not None:
+            repo_url = resume_repo_url
+        else:
+            await progress(phase="repo", repo_name=repo_name)
+            try:
+                if self.github.repository_exists(repo_name):
+                    repo_url = f"https://github.com/atium-research/{repo_name}"
+                else:
+                    repo_url = self.github.create_repository(
+                        repo_name=repo_name,
+                        description=f"Research project: {topic}",
+                        private=False,
+                        auto_init=False,
+                    )
+            except Exception as e:
+                yield {"type": "error", "error": f"Failed to create repository: {e}"}
+                return
+
+        await progress(phase="agent", repo_name=repo_name, repo_url=repo_url)
         clone_url = self.github.get_clone_url(repo_name)
         prompt = self._build_research_prompt(
             topic=topic,
@@ -419,6 +448,8 @@ Begin now. Start with Phase 1."""
             repo_url=repo_url,
             clone_url=clone_url,
         )
+        if resume_repo_url is not None:
+            prompt += RESUME_NOTE
         self.agent.send_message(prompt)
 
         async for msg in self.agent.get_output_stream():
@@ -430,6 +461,12 @@ Begin now. Start with Phase 1."""
                 )
                 yield {"type": "agent_status", "message": status}
             yield msg
+            # The agent keeps waiting for another prompt after its result; the run is over.
+            if msg.get("type") == "result":
+                await progress(phase="done", cost=msg.get("cost"))
+                return
+            if msg.get("type") == "error":
+                return
 
     def _sanitize_repo_name(self, topic: str) -> str:
         """Convert research topic to a valid directory name."""
@@ -0,0 +1,118 @@
+"""
+Research worker: claims queued research jobs from Postgres and runs them.
+
+Run one or more alongside the API with RESEARCH_EXECUTOR=queue:
+    uv run python worker.py
+Jobs are claimed with FOR UPDATE SKIP LOCKED, so any number of workers can
+share the queue. Events are persisted here and reach the API processes'
+subscribers through PostgresPubSub.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import signal
+from typing import Any
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from connection import DROPPABLE_EVENT_TYPES, encode_event
+from research_jobs import WORKER_ID, ResearchJobs
+
+# Research runs per worker process
+RESEARCH_WORKER_CONCURRENCY = int(os.environ.get("RESEARCH_WORKER_CONCURRENCY", "2"))
+# Fallback poll interval when no NOTIFY arrives (seconds)
+RESEARCH_WORKER_POLL = float(os.environ.get("RESEARCH_WORKER_POLL", "5"))
+
+ASSISTANT_PERSIST_MODE = os.environ.get("ASSISTANT_PERSIST_MODE", "block").strip().lower()
+
+logger = logging.getLogger("research_worker")
+
+
+class EventRecorder:
+    """Persists assistant messages like Session._wrap does, then publishes to the API."""
+
+    def __init__(self, chat_store: Any, pubsub: Any) -> None:
+        self._chat_store = chat_store
+        self._pubsub = pubsub
+        self._turn_text: dict[str, list[str]] = {}
+
+    async def publish(self, chat_id: str, event: dict[str, Any]) -> None:
+        t = event.get("type")
+        content: str | None = None
+        if t == "assistant_message":
+            if ASSISTANT_PERSIST_MODE == "turn":
+                self._turn_text.setdefault(chat_id, []).append(event.get("content", ""))
+            else:
+                content = event.get("content", "")
+        elif t in ("result", "error") and self._turn_text.get(chat_id):
+            content = "\n\n".join(self._turn_text.pop(chat_id))
+        if content is not None:
+            stored = await self._chat_store.add_message(chat_id, "assistant", content)
+            event = {**event, "messageId": stored.id, "messageSeq": stored.seq}
+        await self._pubsub.publish(
+            chat_id,
+            encode_event({**event, "chatId": chat_id}),
+            event.get("type") in DROPPABLE_EVENT_TYPES,
+        )
+
+
+async def run_worker() -> None:
+    from db import (
+        PostgresChatStore,
+        PostgresPubSub,
+        PostgresResearchJobStore,
+        PostgresResearchQueue,
+        close_pool,
+        get_pool,
+        init_db,
+    )
+
+    pool = await get_pool()
+    await init_db(pool)
+    queue = PostgresResearchQueue(pool)
+
+    def on_command(chat_id: str, command: dict[str, Any]) -> None:
+        # `cancel` from an API process; only the worker running the chat's job acts on it
+        if command.get("type") == "cancel" and jobs.is_running(chat_id):
+            asyncio.create_task(jobs.cancel(chat_id))
+
+    pubsub = PostgresPubSub(pool, deliver=None, on_command=on_command)
+    recorder = EventRecorder(PostgresChatStore(pool), pubsub)
+    jobs = ResearchJobs(
+        recorder.publish,
+        max_concurrent=RESEARCH_WORKER_CONCURRENCY,
+        store=PostgresResearchJobStore(pool),
+    )
+    await pubsub.start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await jobs.startup()  # heartbeat + resume orphaned jobs
+    logger.info("Research worker %s started (concurrency %d)", WORKER_ID, RESEARCH_WORKER_CONCURRENCY)
+    try:
+        while not stop.is_set():
+            while jobs.has_capacity:
+                job = await queue.claim_next(WORKER_ID)
+                if job is None:
+                    break
+                logger.info("Claimed research job %s for chat %s", job.id, job.chat_id)
+                jobs.run(job)
+            # Woken by NOTIFY on enqueue; polling also picks up freed capacity
+            await queue.wait_for_jobs(RESEARCH_WORKER_POLL)
+    finally:
+        await jobs.shutdown()
+        await queue.close()
+        await pubsub.close()
+        await close_pool()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(run_worker())